@@ -30,6 +30,7 @@ import datetime
 import time
 import json
 import os.path
+import re
 import logging
 
 log = logging.getLogger(__name__)
@@ -266,6 +267,85 @@ class PersonExpires(MaintenanceTask):
                 log.info("%s: deleting expired Person %s", self.IDENTIFIER, p)
                 p.delete()
 
+class People(MaintenanceTask):
+    """
+    Load all Person records once, indexed by fingerprint, key ID, uid and
+    email, for use by the other maintenance tasks.
+
+    Tasks that create or change Person records after this has run should
+    call add() to keep the indices up to date.
+    """
+    NAME = "people"
+    # Load people after expired records have been deleted
+    DEPENDS = [PersonExpires]
+
+    # Key ID lengths indexed by by_keyid
+    KEYID_LENS = (8, 16)
+
+    def run(self):
+        self.by_id = {}
+        self.by_fpr = {}
+        self.by_keyid = {}
+        self.by_uid = {}
+        self.by_email = {}
+        # Key IDs shared by more than one fingerprint
+        self.ambiguous_keyids = set()
+        for p in bmodels.Person.objects.all():
+            self._index(p)
+        log.info("%s: %d people loaded", self.IDENTIFIER, len(self.by_id))
+
+    def _index(self, p):
+        self.by_id[p.pk] = p
+        if p.uid:
+            self.by_uid[p.uid] = p
+        if p.email:
+            self.by_email[p.email] = p
+        if p.fpr and not p.fpr.startswith("FIXME"):
+            self.by_fpr[p.fpr] = p
+            for l in self.KEYID_LENS:
+                keyid = p.fpr[-l:]
+                old = self.by_keyid.get(keyid, None)
+                if old is not None and old.pk != p.pk:
+                    self.ambiguous_keyids.add(keyid)
+                self.by_keyid[keyid] = p
+
+    def _unindex(self, pk):
+        if self.by_id.pop(pk, None) is None: return
+        for idx in (self.by_fpr, self.by_keyid, self.by_uid, self.by_email):
+            for k in [k for k, v in idx.iteritems() if v.pk == pk]:
+                del idx[k]
+
+    def add(self, p):
+        """
+        Add a new Person, or reindex one that has changed
+        """
+        self._unindex(p.pk)
+        self._index(p)
+
+    def lookup(self, key):
+        """
+        Same as Person.lookup, without querying the database
+        """
+        if "@" in key:
+            return self.by_email.get(key, None)
+        elif re.match(r"^[0-9A-Fa-f]{32,40}$", key):
+            return self.by_fpr.get(key.upper(), None)
+        else:
+            return self.by_uid.get(key, None)
+
+    def lookup_keyid(self, keyid):
+        """
+        Return the Person whose fingerprint ends with the given key ID, or None
+        if there is none, or more than one
+        """
+        keyid = keyid.upper()
+        if keyid in self.ambiguous_keyids: return None
+        if len(keyid) in self.KEYID_LENS:
+            return self.by_keyid.get(keyid, None)
+        found = [p for fpr, p in self.by_fpr.iteritems() if fpr.endswith(keyid)]
+        if len(found) != 1: return None
+        return found[0]
+
 class CheckOneProcessPerPerson(MaintenanceTask):
     """
     Check that one does not have more than one open process at the current time
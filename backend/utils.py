@@ -22,8 +22,21 @@ import os.path
 import os
 import errno
 import shutil
+import zlib
 from cStringIO import StringIO
 
+# xz compression is available if python has lzma support
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Supported compressions for compress_stream
+COMPRESSIONS = ("gzip", "xz") if lzma is not None else ("gzip",)
+
 class atomic_writer(object):
     """
     Atomically write to a file
@@ -137,3 +150,26 @@ def require_dir(pathname, mode=0777):
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
+
+
+def compress_stream(chunks, compression):
+    """
+    Compress a sequence of strings as they are generated, yielding the
+    compressed data. Unicode strings are encoded as utf8.
+
+    compression can be one of the values in COMPRESSIONS.
+    """
+    if compression == "gzip":
+        # 16 + MAX_WBITS makes zlib write gzip headers and trailers
+        comp = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compression == "xz" and lzma is not None:
+        comp = lzma.LZMACompressor()
+    else:
+        raise ValueError("unsupported compression %r" % compression)
+
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode("utf-8")
+        data = comp.compress(chunk)
+        if data: yield data
+    yield comp.flush()
@@ -21,7 +21,7 @@ from __future__ import division
 from __future__ import unicode_literals
 from django_maintenance import MaintenanceTask
 from django.db import transaction
-from backend.maintenance import MakeLink, BackupDB, Inconsistencies
+from backend.maintenance import MakeLink, BackupDB, Inconsistencies, People
 from . import models as dmodels
 from backend import const
 import backend.models as bmodels
@@ -33,7 +33,7 @@ class ProgressFinalisationsOnAccountsCreated(MaintenanceTask):
     """
     Update pending dm_ga processes after the account is created
     """
-    DEPENDS = [BackupDB, MakeLink]
+    DEPENDS = [BackupDB, MakeLink, People]
 
     @transaction.commit_on_success
     def run(self):
@@ -59,6 +59,7 @@ class ProgressFinalisationsOnAccountsCreated(MaintenanceTask):
             if finalised_msg is not None:
                 old_status = proc.person.status
                 proc.finalize(finalised_msg)
+                self.maint.people.add(proc.person)
                 log.info("%s: %s finalised: %s changes status %s->%s",
                          self.IDENTIFIER, self.maint.link(proc), proc.person.uid, old_status, proc.person.status)
 
@@ -66,7 +67,7 @@ class NewGuestAccountsFromDSA(MaintenanceTask):
     """
     Create new Person entries for guest accounts created by DSA
     """
-    DEPENDS = [BackupDB, MakeLink, Inconsistencies]
+    DEPENDS = [BackupDB, MakeLink, Inconsistencies, People]
 
     @transaction.commit_on_success
     def run(self):
@@ -75,7 +76,7 @@ class NewGuestAccountsFromDSA(MaintenanceTask):
             if entry.single("gidNumber") == "800" and entry.single("keyFingerPrint") is not None: continue
 
             # Skip people we already know of
-            if bmodels.Person.objects.filter(uid=entry.uid).exists(): continue
+            if entry.uid in self.maint.people.by_uid: continue
 
             # Skip people without fingerprints
             if entry.single("keyFingerPrint") is None: continue
@@ -84,14 +85,12 @@ class NewGuestAccountsFromDSA(MaintenanceTask):
             if entry.single("emailForward") is None: continue
 
             # Check for fingerprint duplicates
-            try:
-                p = bmodels.Person.objects.get(fpr=entry.single("keyFingerPrint"))
+            p = self.maint.people.by_fpr.get(entry.single("keyFingerPrint"), None)
+            if p is not None:
                 self.maint.inconsistencies.log_person(self, p,
                                                       "has the same fingerprint as LDAP uid {}".format(entry.uid),
                                                       ldap_uid=entry.uid)
                 continue
-            except bmodels.Person.DoesNotExist:
-                pass
 
             p = bmodels.Person(
                 cn=entry.single("cn"),
@@ -103,25 +102,22 @@ class NewGuestAccountsFromDSA(MaintenanceTask):
                 status=const.STATUS_MM_GA,
             )
             p.save()
+            self.maint.people.add(p)
             log.info("%s (guest account only) imported from LDAP", self.maint.link(p))
 
 class CheckLDAPConsistency(MaintenanceTask):
     """
     Show entries that do not match between LDAP and our DB
     """
-    DEPENDS = [BackupDB, MakeLink, Inconsistencies]
+    DEPENDS = [BackupDB, MakeLink, Inconsistencies, People]
 
     def run(self):
-        # Prefetch people and index them by uid
-        people_by_uid = dict()
-        for p in bmodels.Person.objects.all():
-            if p.uid is None: continue
-            people_by_uid[p.uid] = p
+        # People indexed by uid
+        people_by_uid = self.maint.people.by_uid
 
         for entry in dmodels.list_people():
-            try:
-                person = bmodels.Person.objects.get(uid=entry.uid)
-            except bmodels.Person.DoesNotExist:
+            person = people_by_uid.get(entry.uid, None)
+            if person is None:
                 fpr = entry.single("keyFingerPrint")
                 if fpr:
                     self.maint.inconsistencies.log_fingerprint(self, fpr,
@@ -144,6 +140,7 @@ class CheckLDAPConsistency(MaintenanceTask):
                              self.IDENTIFIER, self.maint.link(person), person.email, email)
                     person.email = email
                     person.save()
+                    self.maint.people.add(person)
                 # It gives lots of errors when run outside of the debian.org
                 # network, since emailForward is not exported there, and it has
                 # no use case I can think of so far
@@ -21,8 +21,7 @@ from __future__ import division
 from __future__ import unicode_literals
 from django_maintenance import MaintenanceTask
 from django.conf import settings
-from backend.maintenance import MakeLink, Inconsistencies
-import backend.models as bmodels
+from backend.maintenance import MakeLink, Inconsistencies, People
 from backend import const
 from . import models as kmodels
 import os
@@ -43,86 +42,64 @@ class Keyrings(MaintenanceTask):
     """
     NAME = "keyrings"
 
-    KEYID_LEN = 16
+    # Keyring files loaded, by keyring type
+    KEYRING_FILES = (
+        ("dm", "debian-maintainers.gpg"),
+        ("dd_u", "debian-keyring.gpg"),
+        ("dd_nu", "debian-nonupload.gpg"),
+        ("emeritus_dd", "emeritus-keyring.gpg"),
+        ("removed_dd", "removed-keys.pgp"),
+    )
 
-    def run(self):
-        log.info("%s: Importing dm keyring...", self.IDENTIFIER)
-        self.dm = frozenset(kmodels.list_dm())
-        log.info("%s: Importing dd_u keyring...", self.IDENTIFIER)
-        self.dd_u = frozenset(kmodels.list_dd_u())
-        log.info("%s: Importing dd_nu keyring...", self.IDENTIFIER)
-        self.dd_nu = frozenset(kmodels.list_dd_nu())
-        log.info("%s: Importing emeritus_dd keyring...", self.IDENTIFIER)
-        self.emeritus_dd = frozenset(kmodels.list_emeritus_dd())
-        log.info("%s: Importing removed_dd keyring...", self.IDENTIFIER)
-        self.removed_dd = frozenset(kmodels.list_removed_dd())
-
-        # Keep an index mapping key IDs to fingerprints and keyring type
-        self.by_fpr = {}
-        self.by_keyid = {}
-        duplicate_fprs = []
-        duplicate_keyids = []
-        for t in ("dm", "dd_u", "dd_nu", "emeritus_dd", "removed_dd"):
-            for fpr in getattr(self, t):
-                record = (fpr, t)
-
-                # Index by fingerprint
-                old_rec = self.by_fpr.get(fpr, None)
-                if old_rec is not None:
-                    log.warning("%s: duplicate fingerprint %s, found in %s and in %s", self.IDENTIFIER, fpr, old_rec[1], t)
-                    duplicate_fprs.append(fpr)
-                else:
-                    self.by_fpr[fpr] = record
-
-                # Index by key id
-                keyid = fpr[-self.KEYID_LEN:]
-                old_rec = self.by_keyid.get(keyid, None)
-                if old_rec is not None:
-                    log.warning("%s: duplicate key id %s, found in %s and in %s", self.IDENTIFIER, keyid, old_rec[1], t)
-                    duplicate_keyids.append(keyid)
-                else:
-                    self.by_keyid[keyid] = record
+    # Load all keyrings at the same time
+    PARALLEL = getattr(settings, "KEYRINGS_PARALLEL_LOAD", True)
 
-        # Ignore duplicate fingerprints for lookup purposes
-        for fpr in duplicate_fprs:
-            del self.by_fpr[fpr]
-        for keyid in duplicate_keyids:
-            del self.by_keyid[keyid]
+    def run(self):
+        log.info("%s: Importing keyrings%s...", self.IDENTIFIER, " in parallel" if self.PARALLEL else "")
+        # Reuse the process-wide index, which only rereads changed keyrings
+        by_file = kmodels.keyring_index.load(parallel=self.PARALLEL)
+        for t, f in self.KEYRING_FILES:
+            setattr(self, t, by_file[f])
+            log.info("%s: %s keyring: %d keys", self.IDENTIFIER, t, len(by_file[f]))
+
+        # Keep a snapshot of the index mapping fingerprints to keyring files
+        # and key IDs to fingerprints, so that lookups are consistent for the
+        # whole maintenance run
+        with kmodels.keyring_index.lock:
+            self.by_fpr = kmodels.keyring_index.by_fpr
+            self.by_keyid = kmodels.keyring_index.by_keyid
+        self.types = dict((f, t) for t, f in self.KEYRING_FILES)
 
     def resolve_fpr(self, fpr):
         """
         Return the keyring type given a fingerprint, or None if the fingerprint
         is unknown
         """
-        rec = self.by_fpr.get(fpr, None)
-        if rec is None:
+        keyring = self.by_fpr.get(fpr, None)
+        if keyring is None:
             return None
-        return rec[1]
+        return self.types[keyring]
 
     def resolve_keyid(self, keyid):
         """
         Return the (fingerprint, keyring type) given a key id, or (None, None)
         if the key id is unknown
         """
-        rec = self.by_keyid.get(keyid, None)
-        if rec is None:
+        fpr = self.by_keyid.get(keyid, None)
+        if fpr is None:
             return None, None
-        return rec
+        return fpr, self.resolve_fpr(fpr)
 
 
 class CheckKeyringConsistency(MaintenanceTask):
     """
     Show entries that do not match between keyrings and our DB
     """
-    DEPENDS = [Keyrings, MakeLink, Inconsistencies]
+    DEPENDS = [Keyrings, MakeLink, Inconsistencies, People]
 
     def run(self):
-        # Prefetch people and index them by fingerprint
-        people_by_fpr = dict()
-        for p in bmodels.Person.objects.all():
-            if p.fpr is None: continue
-            if p.fpr.startswith("FIXME"): continue
-            people_by_fpr[p.fpr] = p
+        # People indexed by fingerprint
+        people_by_fpr = self.maint.people.by_fpr
 
         keyring_by_status = {
             const.STATUS_DM: self.maint.keyrings.dm,
@@ -240,17 +217,78 @@ def keyring_log_matcher(regexp, **kw):
         return f
     return decorator
 
+class KeyringLogMatchers(object):
+    """
+    Match changelog lines against all keyring_log_matcher methods at once.
+
+    The regular expressions of all methods are combined into one alternation,
+    tried in the same order as the methods, with named groups renamed so that
+    they do not clash. Fallback matchers get a combined expression of their
+    own, only tried if no normal matcher matches.
+    """
+    re_group = re.compile(r"\(\?P<(\w+)>")
+
+    def __init__(self, methods):
+        self.main = self._compile([m for m in methods if not getattr(m, "fallback", False)])
+        self.fallback = self._compile([m for m in methods if getattr(m, "fallback", False)])
+
+    def _compile(self, methods):
+        """
+        Return a couple (regexp, dispatch) combining the regexps of all
+        methods, where dispatch maps the name of the group wrapping each
+        method's regexp to (method, {renamed group: original group name})
+        """
+        if not methods: return None
+        parts = []
+        dispatch = {}
+        for idx, method in enumerate(methods):
+            name = "m{}".format(idx)
+            groups = {}
+            def rename(mo):
+                renamed = "{}_{}".format(name, mo.group(1))
+                groups[renamed] = mo.group(1)
+                return "(?P<{}>".format(renamed)
+            parts.append("(?P<{}>{})".format(name, self.re_group.sub(rename, method.re.pattern)))
+            dispatch[name] = (method, groups)
+        return re.compile("|".join(parts)), dispatch
+
+    def _classify(self, compiled, line):
+        if compiled is None: return None
+        regexp, dispatch = compiled
+        mo = regexp.match(line)
+        if not mo: return None
+        # The group wrapping a whole alternative is the last one to close
+        method, groups = dispatch[mo.lastgroup]
+        return method, dict((orig, mo.group(renamed)) for renamed, orig in groups.iteritems())
+
+    def classify(self, line):
+        """
+        Return (method, kwargs) for the method matching line, or None if no
+        method matches
+        """
+        res = self._classify(self.main, line)
+        if res is None:
+            res = self._classify(self.fallback, line)
+        return res
+
+    def run(self, d, line):
+        """
+        Call the method matching line, returning False if none matched
+        """
+        res = self.classify(line)
+        if res is None: return False
+        method, kw = res
+        method(d, **kw)
+        return True
+
 class CheckKeyringLogs(MaintenanceTask):
     """
     Show entries that do not match between keyrings and our DB
     """
-    DEPENDS = [Inconsistencies, Keyrings]
+    DEPENDS = [Inconsistencies, Keyrings, People]
 
     def person_for_key_id(self, kid):
-        try:
-            return bmodels.Person.objects.get(fpr__endswith=kid)
-        except bmodels.Person.DoesNotExist:
-            return None
+        return self.maint.people.lookup_keyid(kid)
 
     def rturl(self, num):
         return "https://rt.debian.org/" + num
@@ -443,28 +481,17 @@ class CheckKeyringLogs(MaintenanceTask):
             matchers.append(meth)
         return matchers
 
-    def _run_matchers(self, matchers, d, line, fallback=False):
-        for method in matchers:
-            is_fallback = getattr(method, "fallback", False)
-            if fallback != is_fallback: continue
-            mo = method.re.match(line)
-            if mo:
-                method(d, **mo.groupdict())
-                return True
-        return False
-
     def run(self):
         """
         Parse changes from changelog entries after the given date (non inclusive).
         """
         re_import = re.compile(r"^\s*\*\s+Import changes sent to keyring.debian.org HKP interface:")
 
-        matchers = self._find_matchers()
+        matchers = KeyringLogMatchers(self._find_matchers())
 
         changelog = kmodels.Changelog()
         for d, lines in changelog.read(since=datetime.datetime.utcnow() - datetime.timedelta(days=360)):
             if re_import.match(lines[0]): continue
             oneline = " ".join(c.strip() for c in lines)
-            if not self._run_matchers(matchers, d, oneline):
-                self._run_matchers(matchers, d, oneline, fallback=True)
-                # If not even the fallback matchers find anything, give it up
+            # If not even the fallback matchers find anything, give it up
+            matchers.run(d, oneline)
@@ -0,0 +1,98 @@
+# coding: utf-8
+# nm.debian.org keyring changelog matcher benchmark
+#
+# Copyright (C) 2014  Enrico Zini <enrico@debian.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+from django.core.management.base import BaseCommand, CommandError
+import optparse
+import inspect
+import datetime
+import time
+import sys
+import logging
+import keyring.models as kmodels
+from keyring.maintenance import CheckKeyringLogs, KeyringLogMatchers
+
+log = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = "Time the classification of keyring changelog lines by CheckKeyringLogs"
+    option_list = BaseCommand.option_list + (
+        optparse.make_option("--quiet", action="store_true", dest="quiet", default=None, help="Disable progress reporting"),
+        optparse.make_option("--days", action="store", type="int", default=365, help="Days of changelog to use (default: %default)"),
+        optparse.make_option("--rounds", action="store", type="int", default=20, help="Times to classify all lines (default: %default)"),
+    )
+
+    def sequential(self, methods, lines):
+        """
+        Classify lines trying each matcher in turn, as CheckKeyringLogs used
+        to do
+        """
+        res = 0
+        for line in lines:
+            for fallback in (False, True):
+                found = False
+                for method in methods:
+                    if getattr(method, "fallback", False) != fallback: continue
+                    mo = method.re.match(line)
+                    if mo:
+                        mo.groupdict()
+                        found = True
+                        break
+                if found:
+                    res += 1
+                    break
+        return res
+
+    def combined(self, matchers, lines):
+        """
+        Classify lines with a KeyringLogMatchers
+        """
+        res = 0
+        for line in lines:
+            if matchers.classify(line) is not None:
+                res += 1
+        return res
+
+    def handle(self, quiet=False, days=365, rounds=20, **opts):
+        FORMAT = "%(asctime)-15s %(levelname)s %(message)s"
+        if quiet:
+            logging.basicConfig(level=logging.WARNING, stream=sys.stderr, format=FORMAT)
+        else:
+            logging.basicConfig(level=logging.INFO, stream=sys.stderr, format=FORMAT)
+
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        lines = [" ".join(c.strip() for c in l) for d, l in kmodels.Changelog().read(since=since)]
+        if not lines:
+            raise CommandError("no changelog entries found in the last {} days".format(days))
+
+        methods = [m for name, m in inspect.getmembers(CheckKeyringLogs, lambda x:(inspect.ismethod(x) and hasattr(x, "re")))]
+        matchers = KeyringLogMatchers(methods)
+
+        results = []
+        for name, func, arg in (("sequential", self.sequential, methods), ("combined", self.combined, matchers)):
+            start = time.time()
+            for i in xrange(rounds):
+                matched = func(arg, lines)
+            elapsed = time.time() - start
+            results.append(elapsed)
+            print("{}: {} lines, {} matched, {:.1f} lines/s".format(
+                name, len(lines), matched, len(lines) * rounds / elapsed))
+        print("speedup: {:.2f}x".format(results[0] / results[1]))
@@ -23,6 +23,7 @@ from __future__ import unicode_literals
 from django.core.management.base import BaseCommand, CommandError
 import optparse
 import sys
+import re
 import logging
 import keyring.models as kmodels
 
@@ -30,31 +31,49 @@ log = logging.getLogger(__name__)
 
 class Command(BaseCommand):
     help = "keycheck.sh using nm.debian.org's implementation"
+    args = "fpr [fpr...]"
     option_list = BaseCommand.option_list + (
         optparse.make_option("--quiet", action="store_true", dest="quiet", default=None, help="Disable progress reporting"),
     )
 
-    def handle(self, fpr, **opts):
+    def handle(self, *fprs, **opts):
         FORMAT = "%(asctime)-15s %(levelname)s %(message)s"
         if opts["quiet"]:
             logging.basicConfig(level=logging.WARNING, stream=sys.stderr, format=FORMAT)
         else:
             logging.basicConfig(level=logging.INFO, stream=sys.stderr, format=FORMAT)
 
-        for kc in kmodels.keycheck(fpr):
-            print("Key {fpr}: {uids} uids, check: {errors}".format(
-                fpr=kc.key.fpr,
-                uids=len(kc.uids),
-                errors=(", ".join(sorted(kc.errors)) if kc.errors else "ok")
+        if not fprs:
+            raise CommandError("please provide one or more key fingerprints")
+        for fpr in fprs:
+            if not re.match(r"^[0-9A-Fa-f]{32,40}$", fpr):
+                raise CommandError("{} is not a valid key fingerprint".format(fpr))
+
+        if len(fprs) == 1:
+            key = kmodels.UserKey(fprs[0])
+            key.want_key()
+            results = key.keycheck_results().values()
+        else:
+            # Check all keys with one temporary keyring and one gpg run
+            results = [kc.as_dict() for kc in kmodels.UserKey.keycheck_batch(fprs).itervalues()]
+
+        for kc in sorted(results, key=lambda x:x["fpr"]):
+            self.print_result(kc)
+
+    def print_result(self, kc):
+        print("Key {fpr}: {uids} uids, check: {errors}".format(
+            fpr=kc["fpr"],
+            uids=len(kc["uids"]),
+            errors=(", ".join(kc["errors"]) if kc["errors"] else "ok")
+        ))
+        for ku in kc["uids"]:
+            print("  uid {uid}: sigs: {sigs_ok} ok, {sigs_no_key} unknown, {sigs_bad} ??; check: {errors}".format(
+                uid=ku["name"],
+                sigs_ok=len(ku["sigs_ok"]),
+                sigs_no_key=ku["sigs_no_key"],
+                sigs_bad=ku["sigs_bad"],
+                errors=(", ".join(ku["errors"]) if ku["errors"] else "ok")
             ))
-            for ku in kc.uids:
-                print("  uid {uid}: sigs: {sigs_ok} ok, {sigs_no_key} unknown, {sigs_bad} ??; check: {errors}".format(
-                    uid=ku.uid.name,
-                    sigs_ok=len(ku.sigs_ok),
-                    sigs_no_key=len(ku.sigs_no_key),
-                    sigs_bad=len(ku.sigs_bad),
-                    errors=(", ".join(sorted(ku.errors)) if ku.errors else "ok")
-                ))
 
     ## FIXME: return warnings properly
     #if len(fpr) == 32:
@@ -29,18 +29,37 @@ import os
 import os.path
 import subprocess
 from collections import namedtuple
-from backend.utils import StreamStdoutKeepStderr, require_dir
+from backend.utils import StreamStdoutKeepStderr, NamedTemporaryDirectory, require_dir, atomic_writer
+from . import openpgp
 import time
 import re
 import datetime
+import threading
+import Queue
+import hashlib
+import json
+import array
+import binascii
+import cPickle as pickle
 import logging
 
 log = logging.getLogger(__name__)
 
 KEYRINGS = getattr(settings, "KEYRINGS", "/srv/keyring.debian.org/keyrings")
 KEYRINGS_TMPDIR = getattr(settings, "KEYRINGS_TMPDIR", "/srv/keyring.debian.org/data/tmp_keyrings")
+KEYRINGS_CHANGELOG_CACHE = getattr(settings, "KEYRINGS_CHANGELOG_CACHE", "/srv/keyring.debian.org/data/changelog.cache")
 #KEYSERVER = getattr(settings, "KEYSERVER", "keys.gnupg.net")
 KEYSERVER = getattr(settings, "KEYSERVER", "pgp.mit.edu")
+# Maximum age in seconds of cached keycheck results
+KEYCHECK_CACHE_MAX_AGE = getattr(settings, "KEYCHECK_CACHE_MAX_AGE", 86400)
+
+# Number of threads used to refresh keys from the keyserver in background
+KEYSERVER_REFRESH_WORKERS = getattr(settings, "KEYSERVER_REFRESH_WORKERS", 2)
+# Age in seconds after which a user key is refreshed from the keyserver
+KEYSERVER_REFRESH_MAX_AGE = getattr(settings, "KEYSERVER_REFRESH_MAX_AGE", 6 * 3600)
+
+# Reference keyrings used to check signatures in keycheck
+KEYCHECK_KEYRINGS = ("debian-keyring.gpg", "debian-nonupload.gpg")
 
 #WithFingerprint = namedtuple("WithFingerprint", (
 #    "type", "trust", "bits", "alg", "id", "created", "expiry",
@@ -132,29 +151,154 @@ def _check_keyring(keyring, fpr):
     """
     Check if a fingerprint exists in a keyring
     """
-    gpg = GPG()
-    return gpg.has_key(keyring, fpr)
+    return keyring_index.has_key(keyring, fpr)
 
 def _list_keyring(keyring):
     """
     List all fingerprints in a keyring
     """
-    gpg = GPG()
-    cmd = gpg.keyring_cmd(keyring, "--list-keys")
-    proc, lines = gpg.pipe_cmd(cmd)
-    for line in lines:
-        try:
-            line = line.decode('utf8')
-        except:
-            try:
-                line = line.decode('iso8859-1')
-            except:
-                line = line.decode('utf8', 'replace')
-        if not line.startswith("fpr"): continue
-        yield line.split(":")[9]
-    result = proc.wait()
-    if result != 0:
-        raise RuntimeError("gpg exited with status %d: %s" % (result, lines.stderr.getvalue().strip()))
+    for rec in openpgp.list_keys(os.path.join(KEYRINGS, keyring)):
+        if rec[0] != b"fpr": continue
+        yield rec[9].decode("ascii")
+
+class KeyringIndex(object):
+    """
+    In-memory index of the fingerprints found in the keyrings, built once per
+    keyring file and rebuilt only when the file changes on disk.
+
+    It maps fingerprints to the keyring they are in, and key IDs to
+    fingerprints, so that membership checks do not need to run gpg.
+    Fingerprints and key IDs found in more than one keyring are left out of
+    the maps.
+
+    The maps are replaced, never modified, when the index is rebuilt, so a
+    reference to them is a consistent snapshot.
+    """
+    KEYID_LEN = 16
+
+    # Keyrings indexed by the fingerprint and key ID lookups
+    KEYRINGS = ("debian-maintainers.gpg", "debian-keyring.gpg", "debian-nonupload.gpg",
+                "emeritus-keyring.gpg", "removed-keys.pgp")
+
+    def __init__(self):
+        # Keyring name -> ((mtime, size), frozenset of fingerprints)
+        self.keyrings = {}
+        self.by_fpr = {}
+        self.by_keyid = {}
+        self.lock = threading.Lock()
+
+    def _stamp(self, keyring):
+        """
+        Return a value that changes when the keyring file changes
+        """
+        st = os.stat(os.path.join(KEYRINGS, keyring))
+        return st.st_mtime, st.st_size
+
+    def _refresh(self, keyring):
+        """
+        Make sure the index for the given keyring is up to date, returning its
+        set of fingerprints. Must be called with self.lock held.
+        """
+        stamp = self._stamp(keyring)
+        old = self.keyrings.get(keyring, None)
+        if old is not None and old[0] == stamp:
+            return old[1]
+        log.info("%s: indexing keyring", keyring)
+        fprs = frozenset(_list_keyring(keyring))
+        self.keyrings[keyring] = (stamp, fprs)
+        self._reindex()
+        return fprs
+
+    def _reindex(self):
+        """
+        Rebuild the fingerprint and key ID maps from the keyrings loaded so far
+        """
+        by_fpr = {}
+        by_keyid = {}
+        duplicate_fprs = set()
+        duplicate_keyids = set()
+        for keyring in self.KEYRINGS:
+            rec = self.keyrings.get(keyring, None)
+            if rec is None: continue
+            for fpr in rec[1]:
+                old = by_fpr.get(fpr, None)
+                if old is not None:
+                    log.warning("duplicate fingerprint %s, found in %s and in %s", fpr, old, keyring)
+                    duplicate_fprs.add(fpr)
+                else:
+                    by_fpr[fpr] = keyring
+
+                keyid = fpr[-self.KEYID_LEN:]
+                old = by_keyid.get(keyid, None)
+                if old is not None:
+                    log.warning("duplicate key id %s, found in %s and in %s", keyid, old[1], keyring)
+                    duplicate_keyids.add(keyid)
+                else:
+                    by_keyid[keyid] = (fpr, keyring)
+
+        # Ignore duplicates for lookup purposes
+        for fpr in duplicate_fprs:
+            del by_fpr[fpr]
+        for keyid in duplicate_keyids:
+            del by_keyid[keyid]
+        self.by_fpr = by_fpr
+        self.by_keyid = dict((k, v[0]) for k, v in by_keyid.iteritems())
+
+    def load(self, parallel=False):
+        """
+        Make sure that all the keyrings are indexed, reading the changed ones
+        at the same time if parallel is True.
+
+        Returns a dict mapping each keyring name to the frozenset of its
+        fingerprints.
+        """
+        with self.lock:
+            stamps = dict((k, self._stamp(k)) for k in self.KEYRINGS)
+            changed = [k for k in self.KEYRINGS
+                       if k not in self.keyrings or self.keyrings[k][0] != stamps[k]]
+            if changed:
+                for keyring in changed:
+                    log.info("%s: indexing keyring", keyring)
+                for keyring, fprs in list_keyrings(changed, parallel=parallel).iteritems():
+                    self.keyrings[keyring] = (stamps[keyring], fprs)
+                self._reindex()
+            return dict((k, self.keyrings[k][1]) for k in self.KEYRINGS)
+
+    def fingerprints(self, keyring):
+        """
+        Return the set of fingerprints in the given keyring
+        """
+        with self.lock:
+            return self._refresh(keyring)
+
+    def has_key(self, keyring, fpr):
+        """
+        Check if a fingerprint exists in a keyring
+        """
+        return fpr.upper() in self.fingerprints(keyring)
+
+    def resolve_fpr(self, fpr):
+        """
+        Return the name of the keyring containing the given fingerprint, or
+        None if it is not in any keyring
+        """
+        with self.lock:
+            for keyring in self.KEYRINGS:
+                self._refresh(keyring)
+            return self.by_fpr.get(fpr.upper(), None)
+
+    def resolve_keyid(self, keyid):
+        """
+        Return the fingerprint for the given key ID, or None if the key ID is
+        not in any keyring
+        """
+        with self.lock:
+            for keyring in self.KEYRINGS:
+                self._refresh(keyring)
+            return self.by_keyid.get(keyid.upper()[-self.KEYID_LEN:], None)
+
+# Process-wide keyring index
+keyring_index = KeyringIndex()
 
 # def _parse_list_keys_line(line):
 #     res = []
@@ -239,15 +383,61 @@ def list_emeritus_dd():
 def list_removed_dd():
     return _list_keyring("removed-keys.pgp")
 
+def _list_keyring_frozenset(keyring):
+    return frozenset(_list_keyring(keyring))
+
+def list_keyrings(keyrings, parallel=True):
+    """
+    List the fingerprints of several keyrings, returning a dict mapping each
+    keyring name to the frozenset of its fingerprints.
+
+    If parallel is True, keyrings are read at the same time by a pool of
+    worker processes.
+    """
+    keyrings = list(keyrings)
+    if not parallel or len(keyrings) < 2:
+        return dict((k, _list_keyring_frozenset(k)) for k in keyrings)
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes=len(keyrings))
+    try:
+        return dict(zip(keyrings, pool.map(_list_keyring_frozenset, keyrings)))
+    finally:
+        pool.close()
+        pool.join()
+
+def _int_field(val, default=0):
+    """
+    Parse an integer field from gpg --with-colons output
+    """
+    if not val: return default
+    return int(val)
+
+
 class Key(object):
     """
     Collects data about a key, parsed from gpg --with-colons --fixed-list-mode
     """
+    __slots__ = ("fpr", "flags", "bits", "algo", "keyid", "created", "expires", "caps",
+                 "uids", "subkeys", "signers", "signer_idx")
+
     def __init__(self, fpr, pub):
-        self.pub = pub
         self.fpr = fpr
+        # pub:f:1024:17:C5AF774A58510B5A:1082160000:::-:::scESC:
+        self.flags = pub[1]
+        self.bits = _int_field(pub[2])
+        self.algo = _int_field(pub[3])
+        self.keyid = pub[4]
+        self.created = _int_field(pub[5])
+        # None means that the key does not expire
+        self.expires = _int_field(pub[6], None)
+        self.caps = pub[11] if len(pub) > 11 else b""
         self.uids = {}
         self.subkeys = {}
+        # Table of signer uids shared by all the signatures on this key, since
+        # the same signers tend to sign all uids
+        self.signers = []
+        self.signer_idx = {}
 
     def get_uid(self, uid):
         uidfpr = uid[7]
@@ -257,8 +447,19 @@ class Key(object):
         return res
 
     def add_sub(self, sub):
-        subfpr = tuple(sub[3:6])
-        self.subkeys[subfpr] = sub
+        sub = Subkey(sub)
+        self.subkeys[(sub.algo, sub.keyid, sub.created)] = sub
+
+    def signer_index(self, signer):
+        """
+        Return the index of the given signer uid in self.signers, adding it if
+        missing
+        """
+        res = self.signer_idx.get(signer, None)
+        if res is None:
+            res = self.signer_idx[signer] = len(self.signers)
+            self.signers.append(signer.decode("utf8", "replace"))
+        return res
 
     def keycheck(self):
         return KeycheckKeyResult(self)
@@ -305,23 +506,107 @@ class Key(object):
 
         return keys.itervalues()
 
+class Subkey(object):
+    """
+    Data about a subkey, parsed from gpg --with-colons --fixed-list-mode
+    """
+    __slots__ = ("flags", "bits", "algo", "keyid", "created", "expires", "caps")
+
+    def __init__(self, sub):
+        self.flags = sub[1]
+        self.bits = _int_field(sub[2])
+        self.algo = _int_field(sub[3])
+        self.keyid = sub[4]
+        self.created = _int_field(sub[5])
+        # None means that the subkey does not expire
+        self.expires = _int_field(sub[6], None)
+        self.caps = sub[11] if len(sub) > 11 else b""
+
+class Signature(object):
+    """
+    A signature on a uid, as generated by Signatures
+    """
+    __slots__ = ("validity", "algo", "keyid", "created", "signer")
+
+    def __init__(self, validity, algo, keyid, created, signer):
+        self.validity = validity
+        self.algo = algo
+        self.keyid = keyid
+        self.created = created
+        self.signer = signer
+
+class Signatures(object):
+    """
+    Compact storage for the signatures on a uid, using one array per field
+    instead of one object per signature
+    """
+    __slots__ = ("key", "validity", "algo", "keyid", "created", "signer", "seen")
+
+    def __init__(self, key):
+        self.key = key
+        # Validity flag, one byte per signature
+        self.validity = bytearray()
+        self.algo = bytearray()
+        # Binary key IDs, 8 bytes per signature
+        self.keyid = bytearray()
+        self.created = array.array(b"l")
+        # Index of the signer uid in self.key.signers
+        self.signer = array.array(b"l")
+        # Maps signatures already added to their index, so that a later
+        # duplicate replaces the earlier one
+        self.seen = {}
+
+    def __len__(self):
+        return len(self.created)
+
+    def add(self, sig):
+        # sig:!::1:C5AF774A58510B5A:1082160000::::Christoph Berg <cb@df7cb.de>:10x:
+        keyid = sig[4].rjust(16, b"0")[-16:]
+        created = _int_field(sig[5])
+        # FIXME: missing a full fingerprint, we try to index with as much
+        # identifying data as possible
+        seen_key = (int(keyid, 16) << 40) | (created << 8) | _int_field(sig[3])
+        idx = self.seen.get(seen_key, None)
+        if idx is not None:
+            # Same key ID, date and algorithm: only validity and signer can
+            # differ
+            self.validity[idx:idx + 1] = sig[1][:1] or b" "
+            self.signer[idx] = self.key.signer_index(sig[9])
+            return
+        self.seen[seen_key] = len(self.created)
+        self.validity.extend(sig[1][:1] or b" ")
+        self.algo.append(_int_field(sig[3]))
+        self.keyid.extend(binascii.unhexlify(keyid))
+        self.created.append(created)
+        self.signer.append(self.key.signer_index(sig[9]))
+
+    def __iter__(self):
+        signers = self.key.signers
+        for i in xrange(len(self.created)):
+            yield Signature(
+                validity=bytes(self.validity[i:i + 1]).decode("ascii"),
+                algo=self.algo[i],
+                keyid=binascii.hexlify(bytes(self.keyid[i * 8:i * 8 + 8])).upper(),
+                created=self.created[i],
+                signer=signers[self.signer[i]])
+
 class Uid(object):
     """
     Collects data about a key uid, parsed from gpg --with-colons --fixed-list-mode
     """
+    __slots__ = ("key", "flags", "name", "sigs")
+
     re_uid = re.compile(r"^(?P<name>.+?)\s*(?:\((?P<comment>.+)\))?\s*(?:<(?P<email>.+)>)?$")
 
     def __init__(self, key, uid):
+        # uid:q::::1241797807::73B85305F2B11D695B610022AF225CCBC6B3F6D9::Enrico Zini <enrico@enricozini.org>:
         self.key = key
-        self.uid = uid
+        self.flags = uid[1]
         self.name = uid[9].decode("utf8", "replace")
-        self.sigs = {}
+        self.sigs = Signatures(key)
 
     def add_sig(self, sig):
-        # FIXME: missing a full fingerprint, we try to index with as much
-        # identifying data as possible
-        k = tuple(sig[3:6])
-        self.sigs[k] = sig
+        self.sigs.add(sig)
 
     def split(self):
         mo = self.re_uid.match(self.name)
@@ -349,7 +634,7 @@ class KeycheckKeyResult(object):
         # pub:f:1024:17:C5AF774A58510B5A:2004-04-17:::-:Christoph Berg <cb@df7cb.de>::scESC:
 
         # Check key size
-        keysize = int(key.pub[2])
+        keysize = key.bits
         if keysize >= 4096:
             pass
         elif keysize >= 2048:
@@ -358,7 +643,7 @@ class KeycheckKeyResult(object):
             self.errors.add("key_size_small")
 
         # Check key algorithm
-        keyalgo = int(key.pub[3])
+        keyalgo = key.algo
         if keyalgo == 1:
             pass
         elif keyalgo == 17:
@@ -367,7 +652,7 @@ class KeycheckKeyResult(object):
             self.errors.add("key_algo_unknown")
 
         # Check key flags
-        flags = key.pub[1]
+        flags = key.flags
         if "i" in flags: self.errors.update(("skip", "key_invalid"))
         if "d" in flags: self.errors.update(("skip", "key_disabled"))
         if "r" in flags: self.errors.update(("skip", "key_revoked"))
@@ -381,6 +666,10 @@ class KeycheckKeyResult(object):
             if x is None or x == "": return x
             return int(x)
 
+        def key_expire(k):
+            # Expiration of a key or subkey, with "" meaning no expiration
+            return "" if k.expires is None else k.expires
+
         def max_expire(a, b):
             """
             Pick the maximum expiration indication between the two.
@@ -398,14 +687,14 @@ class KeycheckKeyResult(object):
         # Check capabilities
         for cap in "es":
             # Check in primary key
-            if cap in key.pub[11]:
-                self.capabilities[cap] = int_expire(key.pub[6])
+            if cap in key.caps:
+                self.capabilities[cap] = key_expire(key)
 
             # Check in subkeys
             for sk in key.subkeys.itervalues():
-                if cap in sk[11]:
+                if cap in sk.caps:
                     oldcap = self.capabilities.get(cap, None)
-                    self.capabilities[cap] = max_expire(oldcap, sk[6])
+                    self.capabilities[cap] = max_expire(oldcap, key_expire(sk))
 
         cutoff = time.time() + 86400 * 90
 
@@ -421,6 +710,16 @@ class KeycheckKeyResult(object):
         elif c is not "" and c < cutoff:
             self.errors.add("key_signing_expires_soon")
 
+    def as_dict(self):
+        """
+        Return the results as a JSON-serialisable dict
+        """
+        return {
+            "fpr": self.key.fpr,
+            "errors": sorted(self.errors),
+            "uids": [u.as_dict() for u in self.uids],
+        }
+
 
 class KeycheckUidResult(object):
     """
@@ -435,7 +734,7 @@ class KeycheckUidResult(object):
 
         # Check uid flags
 
-        flags = uid.uid[1]
+        flags = uid.flags
         if "i" in flags: self.errors.update(("skip", "uid_invalid"))
         if "d" in flags: self.errors.update(("skip", "uid_disabled"))
         if "r" in flags: self.errors.update(("skip", "uid_revoked"))
@@ -445,20 +744,32 @@ class KeycheckUidResult(object):
         self.sigs_ok = []
         self.sigs_no_key = []
         self.sigs_bad = []
-        for sig in uid.sigs.itervalues():
+        for sig in uid.sigs:
             # Skip self-signatures
-            if self.key_result.key.fpr.endswith(sig[4]): continue
+            if self.key_result.key.fpr.endswith(sig.keyid): continue
             # dkg says:
             # ! means "verified"
             # - means "not verified" (bad signature, signature from expired key)
             # ? means "signature from a key we don't have"
-            if sig[1] == "?" or sig[1] == "-":
+            if sig.validity == "?" or sig.validity == "-":
                 self.sigs_no_key.append(sig)
-            elif sig[1] == "!":
+            elif sig.validity == "!":
                 self.sigs_ok.append(sig)
             else:
                 self.sigs_bad.append(sig)
 
+    def as_dict(self):
+        """
+        Return the results as a JSON-serialisable dict
+        """
+        return {
+            "name": self.uid.name,
+            "errors": sorted(self.errors),
+            "sigs_ok": [x.signer for x in self.sigs_ok],
+            "sigs_no_key": len(self.sigs_no_key),
+            "sigs_bad": len(self.sigs_bad),
+        }
+
 class UserKey(object):
     """
     Manage a temporary keyring use to work with the key of a user that is not
@@ -476,6 +787,7 @@ class UserKey(object):
         require_dir(self.pathname, mode=0770)
         self.gpg = GPG(homedir=self.pathname)
         self.keyring = os.path.join(self.pathname, "user.gpg")
+        self.keycheck_cache = os.path.join(self.pathname, "keycheck.json")
 
     def has_key(self):
         """
@@ -488,6 +800,10 @@ class UserKey(object):
         Fetch/refresh the key
         """
         self.gpg.fetch_key(self.fpr, self.keyring)
+        # gpg does not touch the keyring if the key has not changed: update
+        # its mtime, since we use it as the time of the last refresh
+        if os.path.exists(self.keyring):
+            os.utime(self.keyring, None)
 
     def want_key(self):
         """
@@ -543,7 +859,7 @@ class UserKey(object):
         # and others.
 
         # Check key
-        cmd = self.gpg.keyring_cmd(("debian-keyring.gpg", "debian-nonupload.gpg"), "--keyring", self.keyring, "--check-sigs", self.fpr)
+        cmd = self.gpg.keyring_cmd(KEYCHECK_KEYRINGS, "--keyring", self.keyring, "--check-sigs", self.fpr)
         proc, lines = self.gpg.pipe_cmd(cmd)
         for key in Key.read_from_gpg(lines):
             yield key.keycheck()
@@ -552,12 +868,242 @@ class UserKey(object):
         if result != 0:
             raise RuntimeError("gpg exited with status %d: %s" % (result, lines.stderr.getvalue().strip()))
 
+    @classmethod
+    def keycheck_batch(cls, fprs):
+        """
+        Run keycheck on many keys at once: the keys are fetched together into
+        one shared temporary keyring, and all their signatures are checked
+        with a single gpg invocation.
+
+        Returns a dict mapping the fingerprints of the keys that were found to
+        their KeycheckKeyResult.
+
+        IMPORTANT: make sure that all fprs are validated as in __init__
+        """
+        fprs = [f.upper() for f in fprs]
+        res = {}
+        if not fprs: return res
+
+        require_dir(KEYRINGS_TMPDIR, mode=0770)
+        with NamedTemporaryDirectory(parent=KEYRINGS_TMPDIR) as pathname:
+            gpg = GPG(homedir=pathname)
+            keyring = os.path.join(pathname, "batch.gpg")
+
+            # Fetch all keys at once. gpg fails if any of the keys cannot be
+            # fetched, but we still want to check the others
+            cmd = gpg.keyring_cmd(keyring, "--keyserver", KEYSERVER, "--recv-keys", *fprs)
+            stdout, stderr, result = gpg.run_cmd(cmd)
+            if result != 0:
+                log.warning("gpg exited with status %d fetching %d keys: %s", result, len(fprs), stderr.strip())
+            if not os.path.exists(keyring):
+                return res
+
+            # Check all keys at once, and split the results by key
+            cmd = gpg.keyring_cmd(KEYCHECK_KEYRINGS, "--keyring", keyring, "--check-sigs", *fprs)
+            proc, lines = gpg.pipe_cmd(cmd)
+            for key in Key.read_from_gpg(lines):
+                res[key.fpr] = key.keycheck()
+
+            result = proc.wait()
+            if result != 0:
+                if not res:
+                    raise RuntimeError("gpg exited with status %d: %s" % (result, lines.stderr.getvalue().strip()))
+                log.warning("gpg exited with status %d checking %d keys: %s", result, len(fprs), lines.stderr.getvalue().strip())
+
+        missing = set(fprs) - set(res)
+        if missing:
+            log.warning("%d keys not found: %s", len(missing), ", ".join(sorted(missing)))
+        return res
+
+    def keycheck_cache_key(self):
+        """
+        Return a string that changes whenever the key or any of the reference
+        keyrings used by keycheck change
+        """
+        h = hashlib.sha1()
+        with open(self.keyring, "rb") as fd:
+            while True:
+                buf = fd.read(65536)
+                if not buf: break
+                h.update(buf)
+        for name in KEYCHECK_KEYRINGS:
+            st = os.stat(os.path.join(KEYRINGS, name))
+            h.update("{}:{}:{}\n".format(name, st.st_mtime, st.st_size).encode("utf8"))
+        return h.hexdigest()
+
+    def keycheck_last(self):
+        """
+        Return the last keycheck results that have been computed, even if
+        outdated, as a couple (results, valid).
+
+        results is a dict mapping fingerprints to KeycheckKeyResult.as_dict()
+        values, or None if keycheck has never been run on this key. valid is
+        True if the results are still up to date.
+        """
+        try:
+            with open(self.keycheck_cache) as fd:
+                cached = json.load(fd)
+            res = cached["results"]
+            if cached["ts"] + KEYCHECK_CACHE_MAX_AGE < time.time(): return res, False
+            return res, cached["key"] == self.keycheck_cache_key()
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None, False
+
+    def keycheck_cached(self):
+        """
+        Return the cached keycheck results, as a dict mapping fingerprints to
+        KeycheckKeyResult.as_dict() values, or None if there are no valid
+        cached results
+        """
+        res, valid = self.keycheck_last()
+        if not valid: return None
+        return res
+
+    def keycheck_results(self):
+        """
+        Same as keycheck_cached(), but run keycheck and cache its results if
+        there are no valid cached results
+        """
+        res = self.keycheck_cached()
+        if res is not None: return res
+
+        # The key could not be fetched
+        if not os.path.exists(self.keyring): return {}
+
+        cache_key = self.keycheck_cache_key()
+        res = dict((kc.key.fpr, kc.as_dict()) for kc in self.keycheck())
+        with atomic_writer(self.keycheck_cache, sync=False) as fd:
+            json.dump(dict(ts=time.time(), key=cache_key, results=res), fd)
+        return res
+
+class RefreshQueue(object):
+    """
+    Refresh user keys from the keyserver using a pool of background threads,
+    and recompute their keycheck results.
+
+    Requests to refresh a key that is already queued are coalesced. With
+    zero workers, queued keys are only refreshed by calling drain().
+    """
+    # Number of locks shared among all the user keys
+    KEY_LOCKS = 16
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = KEYSERVER_REFRESH_WORKERS
+        self.workers = workers
+        self.queue = Queue.Queue()
+        # Uppercased fingerprints of the keys queued or being refreshed
+        self.pending = set()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.key_locks = [threading.Lock() for i in range(self.KEY_LOCKS)]
+
+    def key_lock(self, fpr):
+        """
+        Return the lock to hold while running gpg on the temporary keyring of
+        the given key, so that a background refresh and a request do not
+        work on it at the same time
+        """
+        return self.key_locks[hash(fpr.upper()) % len(self.key_locks)]
+
+    def _start_workers(self):
+        """
+        Start worker threads, if they are not running yet. Must be called with
+        self.lock held.
+        """
+        while len(self.threads) < self.workers:
+            t = threading.Thread(target=self._work, name="keyring-refresh-{}".format(len(self.threads)))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def enqueue(self, fpr):
+        """
+        Schedule a refresh of the given key.
+
+        Returns False if a refresh of the key is already pending.
+
+        IMPORTANT: make sure that fpr is validated as in UserKey.__init__
+        """
+        with self.lock:
+            if fpr.upper() in self.pending: return False
+            self.pending.add(fpr.upper())
+            self._start_workers()
+        self.queue.put(fpr)
+        return True
+
+    def is_pending(self, fpr):
+        """
+        Check if a refresh of the given key is queued or running
+        """
+        with self.lock:
+            return fpr.upper() in self.pending
+
+    def join(self):
+        """
+        Wait until all queued refreshes have been done
+        """
+        self.queue.join()
+
+    def drain(self):
+        """
+        Refresh all the queued keys in the calling thread
+        """
+        while True:
+            try:
+                fpr = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            self._refresh(fpr)
+
+    def _work(self):
+        while True:
+            self._refresh(self.queue.get())
+
+    def _refresh(self, fpr):
+        """
+        Refresh a key taken from the queue
+        """
+        try:
+            with self.key_lock(fpr):
+                key = UserKey(fpr)
+                key.refresh()
+                key.keycheck_results()
+        except Exception:
+            log.exception("%s: background refresh failed", fpr)
+        finally:
+            with self.lock:
+                self.pending.discard(fpr.upper())
+            self.queue.task_done()
+
+# Process-wide queue of keys to refresh
+refresh_queue = RefreshQueue()
+
 class Changelog(object):
+    """
+    Incremental parser for the keyring changelog.
+
+    Parsed entries are cached in memory and in KEYRINGS_CHANGELOG_CACHE, so
+    that each run only parses the entries added since the previous one.
+    """
+    # Version of the format of the cache file
+    CACHE_FORMAT = 1
+
     re_date = re.compile("^\d+-\d+-\d+$")
     re_datetime = re.compile("^\d+-\d+-\d+ \d+:\d+:\d+$")
     re_empty = re.compile(r"^\s*$")
     re_author = re.compile(r"^\s+\[")
 
+    def __init__(self, fname=None, cachefile=None):
+        if fname is None:
+            fname = os.path.join(KEYRINGS, "../changelog")
+        if cachefile is None:
+            cachefile = KEYRINGS_CHANGELOG_CACHE
+        self.fname = fname
+        self.cachefile = cachefile
+        # Parsed (date, lines) entry groups, newest first
+        self.groups = None
+
     def _parse_date(self, s):
         import rfc822
         if self.re_date.match(s):
@@ -620,18 +1166,82 @@ class Changelog(object):
         if group:
             yield group
 
-    def read(self, since=None):
+    def _parse(self, text):
         """
-        Read and parse the keyring changelogs
+        Parse changelog text, returning the list of (date, lines) entry groups
+        it contains
         """
         from debian import changelog
 
-        fname = os.path.join(KEYRINGS, "../changelog")
-        with open(fname) as fd:
-            changes = changelog.Changelog(file=fd)
-
-        for c in changes:
+        res = []
+        for c in changelog.Changelog(text):
             d = self._parse_date(c.date)
-            if since is not None and d <= since: continue
             for lines in self._group_lines_by_indentation(c.changes()):
-                yield d, lines
+                res.append((d, lines))
+        return res
+
+    def _load_state(self):
+        """
+        Read the state saved by the last run, or None if there is no usable
+        saved state
+        """
+        try:
+            with open(self.cachefile, "rb") as fd:
+                state = pickle.load(fd)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        if not isinstance(state, dict) or state.get("format") != self.CACHE_FORMAT:
+            return None
+        return state
+
+    def _save_state(self, state):
+        with atomic_writer(self.cachefile, sync=False) as fd:
+            pickle.dump(state, fd, pickle.HIGHEST_PROTOCOL)
+
+    def load(self):
+        """
+        Return the list of (date, lines) entry groups in the changelog, newest
+        first.
+
+        New changelog entries are added at the top of the file, so we remember
+        the size of the file and its first line: if the old first line is now
+        found at (new size - old size), only the bytes before it need parsing,
+        and the rest comes from the cached entry groups.
+        """
+        if self.groups is not None: return self.groups
+
+        state = self._load_state()
+        with open(self.fname, "rb") as fd:
+            size = os.fstat(fd.fileno()).st_size
+            head = fd.readline()
+
+            offset = None
+            if state is not None and size >= state["size"]:
+                fd.seek(size - state["size"])
+                if fd.readline() == state["head"]:
+                    offset = size - state["size"]
+
+            if offset is None:
+                if state is not None:
+                    log.info("%s: changelog rewritten since last run, parsing it all", self.fname)
+                fd.seek(0)
+                groups = self._parse(fd.read())
+            elif offset > 0:
+                fd.seek(0)
+                groups = self._parse(fd.read(offset)) + state["groups"]
+                log.info("%s: parsed %d new bytes of changelog", self.fname, offset)
+            else:
+                groups = state["groups"]
+
+        if offset != 0:
+            self._save_state(dict(format=self.CACHE_FORMAT, size=size, head=head, groups=groups))
+        self.groups = groups
+        return groups
+
+    def read(self, since=None):
+        """
+        Read and parse the keyring changelogs
+        """
+        for d, lines in self.load():
+            if since is not None and d <= since: continue
+            yield d, lines
@@ -0,0 +1,544 @@
+# coding: utf-8
+# nm.debian.org OpenPGP keyring parser
+#
+# Copyright (C) 2014  Enrico Zini <enrico@debian.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Read binary OpenPGP keyrings without running gpg.
+
+This only parses the packet structure (RFC4880): it does not verify
+signatures, so anything that needs --check-sigs still has to go through gpg.
+The output mimics the records of gpg --with-colons --fixed-list-mode, so that
+code written to parse gpg output can read from here unchanged.
+"""
+
+# No unicode_literals here: this module works on raw bytes
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import os
+import mmap
+import struct
+import hashlib
+import binascii
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+# Packet tags
+TAG_SIGNATURE = 2
+TAG_SECRET_KEY = 5
+TAG_PUBLIC_KEY = 6
+TAG_SECRET_SUBKEY = 7
+TAG_TRUST = 12
+TAG_USER_ID = 13
+TAG_PUBLIC_SUBKEY = 14
+TAG_USER_ATTRIBUTE = 17
+
+# Signature subpacket types
+SUB_CREATED = 2
+SUB_SIG_EXPIRES = 3
+SUB_KEY_EXPIRES = 9
+SUB_ISSUER = 16
+SUB_PRIMARY_UID = 25
+SUB_KEY_FLAGS = 27
+SUB_ISSUER_FPR = 33
+
+# Key sizes of elliptic curves, indexed by hex OID
+CURVE_BITS = {
+    b"2A8648CE3D030107": 256,        # NIST P-256
+    b"2B81040022": 384,              # NIST P-384
+    b"2B81040023": 521,              # NIST P-521
+    b"2B2403030208010107": 256,      # brainpoolP256r1
+    b"2B240303020801010B": 384,      # brainpoolP384r1
+    b"2B240303020801010D": 512,      # brainpoolP512r1
+    b"2B06010401DA470F01": 255,      # Ed25519
+    b"2B060104019755010501": 255,    # Curve25519
+}
+
+# Capabilities implied by the public key algorithm, used when a key has no
+# key flags subpacket
+ALGO_CAPS = {
+    1: b"esca", 2: b"e", 3: b"sc", 16: b"e", 17: b"sca", 18: b"e", 19: b"sca",
+    20: b"esc", 22: b"sca",
+}
+
+
+class ParseError(Exception):
+    pass
+
+
+def _u8(buf, pos):
+    return struct.unpack_from(b">B", buf, pos)[0]
+
+def _u16(buf, pos):
+    return struct.unpack_from(b">H", buf, pos)[0]
+
+def _u32(buf, pos):
+    return struct.unpack_from(b">I", buf, pos)[0]
+
+def _hex(data):
+    return binascii.hexlify(data).upper()
+
+
+def iter_packets(buf):
+    """
+    Generate (tag, body) for all the packets in buf
+    """
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        c = _u8(buf, pos)
+        pos += 1
+        if not c & 0x80:
+            raise ParseError("offset {}: invalid packet header 0x{:02x}".format(pos - 1, c))
+
+        if c & 0x40:
+            # New format packet
+            tag = c & 0x3f
+            chunks = []
+            while True:
+                l1 = _u8(buf, pos)
+                if l1 < 192:
+                    size = l1
+                    pos += 1
+                elif l1 < 224:
+                    size = ((l1 - 192) << 8) + _u8(buf, pos + 1) + 192
+                    pos += 2
+                elif l1 == 255:
+                    size = _u32(buf, pos + 1)
+                    pos += 5
+                else:
+                    # Partial body length: more chunks follow
+                    size = 1 << (l1 & 0x1f)
+                    pos += 1
+                    chunks.append(buf[pos:pos + size])
+                    pos += size
+                    continue
+                chunks.append(buf[pos:pos + size])
+                pos += size
+                break
+            body = b"".join(chunks) if len(chunks) > 1 else chunks[0]
+        else:
+            # Old format packet
+            tag = (c >> 2) & 0x0f
+            ltype = c & 0x03
+            if ltype == 0:
+                size = _u8(buf, pos)
+                pos += 1
+            elif ltype == 1:
+                size = _u16(buf, pos)
+                pos += 2
+            elif ltype == 2:
+                size = _u32(buf, pos)
+                pos += 4
+            else:
+                size = end - pos
+            body = buf[pos:pos + size]
+            pos += size
+
+        if pos > end:
+            raise ParseError("offset {}: packet extends past the end of the data".format(pos))
+        yield tag, body
+
+
+def _mpi(body, pos):
+    """
+    Read an MPI at the given position, returning (bits, value bytes, next position)
+    """
+    bits = _u16(body, pos)
+    size = (bits + 7) // 8
+    return bits, body[pos + 2:pos + 2 + size], pos + 2 + size
+
+
+class PublicKey(object):
+    """
+    A parsed public key or public subkey packet
+    """
+    __slots__ = ("version", "created", "days_valid", "algo", "bits", "fpr", "keyid")
+
+    def __init__(self, body):
+        self.version = _u8(body, 0)
+        self.days_valid = 0
+        if self.version in (2, 3):
+            self.created = _u32(body, 1)
+            self.days_valid = _u16(body, 5)
+            self.algo = _u8(body, 7)
+            self.bits, n, pos = _mpi(body, 8)
+            ebits, e, pos = _mpi(body, pos)
+            self.fpr = _hex(hashlib.md5(n + e).digest())
+            self.keyid = _hex(n[-8:])
+        elif self.version == 4:
+            self.created = _u32(body, 1)
+            self.algo = _u8(body, 5)
+            if self.algo in (18, 19, 22):
+                oidlen = _u8(body, 6)
+                self.bits = CURVE_BITS.get(_hex(body[7:7 + oidlen]), 0)
+            else:
+                self.bits = _u16(body, 6)
+            self.fpr = _hex(hashlib.sha1(b"\x99" + struct.pack(b">H", len(body)) + body).digest())
+            self.keyid = self.fpr[-16:]
+        else:
+            raise ParseError("unsupported key version {}".format(self.version))
+
+
+class Signature(object):
+    """
+    A parsed signature packet
+    """
+    __slots__ = ("sigclass", "algo", "created", "expires", "key_expires", "keyid", "key_flags", "primary_uid")
+
+    def __init__(self, body):
+        version = _u8(body, 0)
+        self.expires = None
+        self.key_expires = None
+        self.key_flags = None
+        self.primary_uid = False
+        if version in (2, 3):
+            self.sigclass = _u8(body, 2)
+            self.created = _u32(body, 3)
+            self.keyid = _hex(body[7:15])
+            self.algo = _u8(body, 15)
+        elif version == 4:
+            self.sigclass = _u8(body, 1)
+            self.algo = _u8(body, 2)
+            self.created = None
+            self.keyid = None
+            hlen = _u16(body, 4)
+            self._read_subpackets(body[6:6 + hlen], hashed=True)
+            ulen = _u16(body, 6 + hlen)
+            self._read_subpackets(body[8 + hlen:8 + hlen + ulen], hashed=False)
+        else:
+            raise ParseError("unsupported signature version {}".format(version))
+
+    def _read_subpackets(self, buf, hashed):
+        pos = 0
+        end = len(buf)
+        while pos < end:
+            l1 = _u8(buf, pos)
+            if l1 < 192:
+                size = l1
+                pos += 1
+            elif l1 < 255:
+                size = ((l1 - 192) << 8) + _u8(buf, pos + 1) + 192
+                pos += 2
+            else:
+                size = _u32(buf, pos + 1)
+                pos += 5
+            if size == 0:
+                continue
+            stype = _u8(buf, pos) & 0x7f
+            data = buf[pos + 1:pos + size]
+            pos += size
+            if stype == SUB_ISSUER and self.keyid is None:
+                self.keyid = _hex(data)
+            elif stype == SUB_ISSUER_FPR and self.keyid is None and len(data) == 21:
+                self.keyid = _hex(data[-8:])
+            elif not hashed:
+                # Only trust the hashed area for everything else
+                continue
+            elif stype == SUB_CREATED:
+                self.created = _u32(data, 0)
+            elif stype == SUB_SIG_EXPIRES:
+                self.expires = _u32(data, 0)
+            elif stype == SUB_KEY_EXPIRES:
+                self.key_expires = _u32(data, 0)
+            elif stype == SUB_KEY_FLAGS and data:
+                self.key_flags = _u8(data, 0)
+            elif stype == SUB_PRIMARY_UID and data:
+                self.primary_uid = _u8(data, 0) != 0
+
+    @property
+    def is_revocation(self):
+        return self.sigclass in (0x20, 0x28, 0x30)
+
+
+def _escape(s):
+    """
+    Escape a uid the way gpg --with-colons does
+    """
+    res = []
+    for c in bytearray(s):
+        if c < 0x20 or c in (0x3a, 0x5c):
+            res.append(b"\\x%02x" % c)
+        else:
+            res.append(struct.pack(b">B", c))
+    return b"".join(res)
+
+def _uid_hash(uid):
+    try:
+        h = hashlib.new("ripemd160")
+    except ValueError:
+        h = hashlib.sha1()
+    h.update(uid)
+    return h.hexdigest().upper().encode("ascii")
+
+def _chars(s):
+    """
+    Split a byte string into single-byte strings
+    """
+    return [s[i:i + 1] for i in range(len(s))]
+
+def _caps(key, flags):
+    """
+    Compute the capabilities of a key, from its key flags if available,
+    otherwise from its algorithm
+    """
+    if flags is None:
+        return ALGO_CAPS.get(key.algo, b"")
+    res = b""
+    if flags & 0x0c: res += b"e"
+    if flags & 0x02: res += b"s"
+    if flags & 0x01: res += b"c"
+    if flags & 0x20: res += b"a"
+    return res
+
+def _sort_caps(caps):
+    """
+    Sort capability letters in the order used by gpg
+    """
+    return b"".join(sorted(caps, key=lambda c: b"esca".find(c.lower())))
+
+
+class KeyBlock(object):
+    """
+    A transferable public key: primary key, uids, subkeys and their signatures
+    """
+    def __init__(self, key):
+        self.key = key
+        # Signatures directly on the primary key
+        self.sigs = []
+        # List of (uid bytes, [signatures])
+        self.uids = []
+        # List of (PublicKey, [signatures])
+        self.subkeys = []
+
+    def _is_self(self, sig):
+        return sig.keyid == self.key.keyid
+
+    def _latest_self_sig(self, sigs, classes):
+        res = None
+        for sig in sigs:
+            if sig.sigclass not in classes or not self._is_self(sig): continue
+            if res is None or (sig.created or 0) > (res.created or 0):
+                res = sig
+        return res
+
+    def _sorted_uids(self):
+        """
+        Return self.uids with the primary uid first, as gpg lists them.
+
+        The primary uid is the one whose latest self certification has the
+        primary uid flag, or the one with the latest self certification if
+        none has it. If several qualify, the most recent certification wins.
+        """
+        best = None
+        best_sort = None
+        for idx, (uid, uid_sigs) in enumerate(self.uids):
+            cert = self._latest_self_sig(uid_sigs, (0x10, 0x11, 0x12, 0x13))
+            if cert is None: continue
+            sort = (cert.primary_uid, cert.created or 0)
+            if best_sort is None or sort > best_sort:
+                best, best_sort = idx, sort
+        if not best: return self.uids
+        return [self.uids[best]] + self.uids[:best] + self.uids[best + 1:]
+
+    def _validity(self, revoked, expires, now):
+        if revoked: return b"r"
+        if expires and expires < now: return b"e"
+        return b"-"
+
+    def records(self, sigs=False, now=None):
+        """
+        Generate gpg --with-colons --fixed-list-mode records for this key, as
+        lists of byte strings
+        """
+        if now is None: now = time.time()
+        key = self.key
+
+        # Primary key expiration and flags come from the latest self
+        # certification of the primary uid. A direct key signature only
+        # provides the ones that the certification does not have: it may
+        # have no such subpackets at all, as with designated revokers
+        flags = key_expires = None
+        uids = self._sorted_uids()
+        if uids:
+            cert = self._latest_self_sig(uids[0][1], (0x10, 0x11, 0x12, 0x13))
+            if cert is not None:
+                flags, key_expires = cert.key_flags, cert.key_expires
+        direct = self._latest_self_sig(self.sigs, (0x1f,))
+        if direct is not None:
+            if flags is None: flags = direct.key_flags
+            if key_expires is None: key_expires = direct.key_expires
+        expires = None
+        if key.days_valid:
+            expires = key.created + key.days_valid * 86400
+        elif key_expires:
+            expires = key.created + key_expires
+        revoked = any(s.sigclass == 0x20 and self._is_self(s) for s in self.sigs)
+        validity = self._validity(revoked, expires, now)
+
+        key_caps = _caps(key, flags)
+        all_caps = set(_chars(key_caps))
+        subs = []
+        for sub, sub_sigs in self.subkeys:
+            binding = self._latest_self_sig(sub_sigs, (0x18,))
+            sub_flags = binding.key_flags if binding is not None else None
+            sub_expires = None
+            if sub.days_valid:
+                sub_expires = sub.created + sub.days_valid * 86400
+            elif binding is not None and binding.key_expires:
+                sub_expires = sub.created + binding.key_expires
+            sub_revoked = any(s.sigclass == 0x28 and self._is_self(s) for s in sub_sigs)
+            sub_validity = self._validity(revoked or sub_revoked, sub_expires, now)
+            sub_caps = _caps(sub, sub_flags)
+            if sub_validity == b"-":
+                all_caps.update(_chars(sub_caps))
+            subs.append((sub, sub_sigs, sub_validity, sub_expires, sub_caps))
+        # Capabilities of the whole key are only listed if it is usable
+        if validity == b"-":
+            key_caps += _sort_caps(c.upper() for c in all_caps)
+
+        def s(val):
+            return b"" if val is None else str(val).encode("ascii")
+
+        yield [b"pub", validity, s(key.bits), s(key.algo), key.keyid, s(key.created), s(expires),
+               b"", b"", b"", b"", key_caps, b""]
+        yield [b"fpr", b"", b"", b"", b"", b"", b"", b"", b"", key.fpr, b""]
+
+        def sig_records(sig_list):
+            for sig in sig_list:
+                sig_expires = None
+                if sig.expires and sig.created:
+                    sig_expires = sig.created + sig.expires
+                yield [b"rev" if sig.is_revocation else b"sig", b"", b"", s(sig.algo), sig.keyid or b"",
+                       s(sig.created), s(sig_expires), b"", b"", b"", b"%02xx" % sig.sigclass, b""]
+
+        if sigs:
+            for rec in sig_records(self.sigs):
+                yield rec
+
+        for uid, uid_sigs in self._sorted_uids():
+            cert = self._latest_self_sig(uid_sigs, (0x10, 0x11, 0x12, 0x13))
+            rev = self._latest_self_sig(uid_sigs, (0x30,))
+            uid_revoked = rev is not None and (cert is None or (rev.created or 0) >= (cert.created or 0))
+            uid_validity = self._validity(revoked or uid_revoked, expires, now)
+            yield [b"uid", uid_validity, b"", b"", b"", s(cert.created if cert else None), b"",
+                   _uid_hash(uid), b"", _escape(uid), b""]
+            if sigs:
+                for rec in sig_records(uid_sigs):
+                    yield rec
+
+        for sub, sub_sigs, sub_validity, sub_expires, sub_caps in subs:
+            yield [b"sub", sub_validity, s(sub.bits), s(sub.algo), sub.keyid, s(sub.created), s(sub_expires),
+                   b"", b"", b"", b"", sub_caps, b""]
+            if sigs:
+                for rec in sig_records(sub_sigs):
+                    yield rec
+
+
+def iter_keyblocks(buf):
+    """
+    Generate KeyBlock objects for all the public keys in buf
+    """
+    block = None
+    # Where signatures go: the primary key, the last uid or the last subkey
+    sig_target = None
+    for tag, body in iter_packets(buf):
+        if tag == TAG_PUBLIC_KEY:
+            if block is not None: yield block
+            try:
+                block = KeyBlock(PublicKey(body))
+                sig_target = block.sigs
+            except (ParseError, struct.error) as e:
+                log.warning("skipping unparsable public key: %s", e)
+                block = sig_target = None
+        elif tag == TAG_SECRET_KEY:
+            if block is not None: yield block
+            block = sig_target = None
+        elif block is None:
+            continue
+        elif tag == TAG_USER_ID:
+            sigs = []
+            block.uids.append((bytes(body), sigs))
+            sig_target = sigs
+        elif tag == TAG_USER_ATTRIBUTE:
+            # Photo ids are not listed: drop their signatures
+            sig_target = None
+        elif tag == TAG_PUBLIC_SUBKEY:
+            sigs = []
+            try:
+                block.subkeys.append((PublicKey(body), sigs))
+                sig_target = sigs
+            except (ParseError, struct.error) as e:
+                log.warning("%s: skipping unparsable subkey: %s", block.key.fpr, e)
+                sig_target = None
+        elif tag == TAG_SIGNATURE:
+            if sig_target is None: continue
+            try:
+                sig_target.append(Signature(body))
+            except (ParseError, struct.error) as e:
+                log.warning("%s: skipping unparsable signature: %s", block.key.fpr, e)
+    if block is not None: yield block
+
+
+class Keyring(object):
+    """
+    Memory-mapped access to a binary keyring file
+    """
+    def __init__(self, pathname):
+        self.pathname = pathname
+
+    def __enter__(self):
+        self.fd = open(self.pathname, "rb")
+        size = os.fstat(self.fd.fileno()).st_size
+        if size == 0:
+            # mmap refuses to map empty files
+            self.buf = b""
+        else:
+            self.buf = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not isinstance(self.buf, bytes):
+            self.buf.close()
+        self.fd.close()
+        return False
+
+    def keyblocks(self):
+        return iter_keyblocks(self.buf)
+
+
+def list_keys(pathname, sigs=False):
+    """
+    Generate the colon-separated records that gpg --with-colons
+    --fixed-list-mode --with-fingerprint --list-keys (or --list-sigs, if sigs
+    is True) would print for the given keyring, as lists of byte strings.
+    """
+    now = time.time()
+    with Keyring(pathname) as keyring:
+        for block in keyring.keyblocks():
+            for rec in block.records(sigs=sigs, now=now):
+                yield rec
+
+
+def list_lines(pathname, sigs=False):
+    """
+    Same as list_keys, but generate newline-terminated lines, like the output
+    of gpg would be read through backend.utils.StreamStdoutKeepStderr
+    """
+    for rec in list_keys(pathname, sigs=sigs):
+        yield b":".join(rec) + b"\n"
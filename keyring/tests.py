@@ -20,7 +20,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 from django.test import TestCase
+from backend.utils import NamedTemporaryDirectory
 from . import models as kmodels
+from . import openpgp
+import os.path
+import BaseHTTPServer
+import threading
+import urlparse
 
 
 class LookupTest(TestCase):
@@ -41,3 +47,190 @@ class LookupTest(TestCase):
         self.assertTrue(kmodels.is_dm(fpr))
         self.assertFalse(kmodels.is_dd_u(fpr))
         self.assertFalse(kmodels.is_dd_nu(fpr))
+
+    def test_index(self):
+        fpr = next(kmodels.list_dm())
+        self.assertEquals(kmodels.keyring_index.resolve_fpr(fpr), "debian-maintainers.gpg")
+        self.assertEquals(kmodels.keyring_index.resolve_keyid(fpr[-16:]), fpr)
+        self.assertTrue(kmodels.keyring_index.has_key("debian-maintainers.gpg", fpr.lower()))
+
+    def test_native_parser(self):
+        # The native keyring parser finds the same keys as gpg
+        gpg = kmodels.GPG()
+        cmd = gpg.keyring_cmd("debian-maintainers.gpg", "--list-keys")
+        stdout, stderr, result = gpg.run_cmd(cmd)
+        self.assertEquals(result, 0)
+        gpg_fprs = set(l.split(b":")[9].decode("ascii") for l in stdout.splitlines() if l.startswith(b"fpr:"))
+        self.assertEquals(set(kmodels.list_dm()), gpg_fprs)
+
+    def test_native_parser_records(self):
+        # The native keyring parser computes the same validity, expiration
+        # and capabilities as gpg
+        def fields(rec):
+            # Type, validity, key ID or uid, expiration, capabilities
+            rec = list(rec) + [b""] * 12
+            return rec[0], rec[1], rec[9] if rec[0] == b"uid" else rec[4], rec[6], rec[11]
+        for name in kmodels.KeyringIndex.KEYRINGS:
+            gpg = kmodels.GPG()
+            cmd = gpg.keyring_cmd(name, "--list-keys")
+            stdout, stderr, result = gpg.run_cmd(cmd)
+            self.assertEquals(result, 0)
+            gpg_recs = [fields(l.split(b":")) for l in stdout.splitlines()
+                        if l.split(b":")[0] in (b"pub", b"sub", b"uid")]
+            native_recs = [fields(r) for r in openpgp.list_keys(os.path.join(kmodels.KEYRINGS, name))
+                           if r[0] in (b"pub", b"sub", b"uid")]
+            self.assertEquals(native_recs, gpg_recs)
+
+    def test_list_keyrings(self):
+        names = ("debian-maintainers.gpg", "debian-keyring.gpg")
+        self.assertEquals(kmodels.list_keyrings(names, parallel=True),
+                          kmodels.list_keyrings(names, parallel=False))
+
+
+class KeyserverStandIn(object):
+    """
+    Minimal HKP keyserver serving keys from the local keyrings, used to test
+    key fetching without network access.
+
+    Requests are only answered after self.release is set.
+    """
+    def __init__(self):
+        self.requests = []
+        self.release = threading.Event()
+        standin = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse.urlparse(self.path)
+                args = urlparse.parse_qs(url.query)
+                search = args.get("search", [""])[0]
+                if search.startswith("0x"): search = search[2:]
+                standin.requests.append(search)
+                standin.release.wait()
+                gpg = kmodels.GPG()
+                cmd = gpg.keyring_cmd(kmodels.KeyringIndex.KEYRINGS, "--armor", "--export", search)
+                stdout, stderr, result = gpg.run_cmd(cmd)
+                if url.path != "/pks/lookup" or result != 0 or not stdout:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/pgp-keys")
+                self.send_header("Content-Length", str(len(stdout)))
+                self.end_headers()
+                self.wfile.write(stdout)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "hkp://127.0.0.1:{}".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RefreshQueueTest(TestCase):
+    def setUp(self):
+        self.fpr = next(kmodels.list_dm())
+        self.keyserver = KeyserverStandIn()
+        self.tmpdir = NamedTemporaryDirectory()
+        self.orig = kmodels.KEYSERVER, kmodels.KEYRINGS_TMPDIR
+        kmodels.KEYSERVER = self.keyserver.url
+        kmodels.KEYRINGS_TMPDIR = self.tmpdir.__enter__()
+
+    def tearDown(self):
+        kmodels.KEYSERVER, kmodels.KEYRINGS_TMPDIR = self.orig
+        self.keyserver.close()
+        self.tmpdir.__exit__(None, None, None)
+
+    def test_refresh(self):
+        # No worker threads: the queue is drained explicitly below
+        queue = kmodels.RefreshQueue(workers=0)
+        self.assertTrue(queue.enqueue(self.fpr))
+        # Further requests are coalesced while the refresh is pending
+        self.assertFalse(queue.enqueue(self.fpr))
+        self.assertFalse(queue.enqueue(self.fpr.lower()))
+        self.assertTrue(queue.is_pending(self.fpr))
+        self.keyserver.release.set()
+        queue.drain()
+        self.assertFalse(queue.is_pending(self.fpr))
+        self.assertEquals(queue.queue.qsize(), 0)
+        self.assertEquals(len(self.keyserver.requests), 1)
+
+        # The refresh computed fresh keycheck results
+        key = kmodels.UserKey(self.fpr)
+        res, valid = key.keycheck_last()
+        self.assertTrue(valid)
+        self.assertIn(self.fpr, res)
+
+
+class ChangelogTest(TestCase):
+    ENTRY = """debian-keyring ({version}) unstable; urgency=low
+
+  * Add new DM key 0x{key} (Test Person) (RT #{rt})
+
+ -- Test Maintainer <test@example.org>  {date}
+
+"""
+
+    def entry(self, version, key, rt, date):
+        return self.ENTRY.format(version=version, key=key, rt=rt, date=date)
+
+    def test_incremental(self):
+        import os.path
+        with NamedTemporaryDirectory() as pathname:
+            fname = os.path.join(pathname, "changelog")
+            cachefile = os.path.join(pathname, "changelog.cache")
+            old = self.entry("2014.01.02", "0123456789ABCDEF", 2, "Thu, 02 Jan 2014 10:00:00 +0000") + \
+                  self.entry("2014.01.01", "1123456789ABCDEF", 1, "Wed, 01 Jan 2014 10:00:00 +0000")
+            with open(fname, "w") as fd:
+                fd.write(old)
+            entries = list(kmodels.Changelog(fname, cachefile).read())
+            self.assertEquals(len(entries), 2)
+
+            # New entries are added at the top
+            with open(fname, "w") as fd:
+                fd.write(self.entry("2014.01.03", "2123456789ABCDEF", 3, "Fri, 03 Jan 2014 10:00:00 +0000"))
+                fd.write(old)
+            entries = list(kmodels.Changelog(fname, cachefile).read())
+            self.assertEquals(len(entries), 3)
+            self.assertIn("2123456789ABCDEF", entries[0][1][0])
+            self.assertIn("1123456789ABCDEF", entries[2][1][0])
+
+            # Only entries after since are returned
+            import datetime
+            entries = list(kmodels.Changelog(fname, cachefile).read(since=datetime.datetime(2014, 1, 2, 12)))
+            self.assertEquals(len(entries), 1)
+
+            # A rewritten changelog is parsed from scratch
+            with open(fname, "w") as fd:
+                fd.write(self.entry("2014.01.04", "3123456789ABCDEF", 4, "Sat, 04 Jan 2014 10:00:00 +0000"))
+            entries = list(kmodels.Changelog(fname, cachefile).read())
+            self.assertEquals(len(entries), 1)
+            self.assertIn("3123456789ABCDEF", entries[0][1][0])
+
+
+class KeyringLogMatchersTest(TestCase):
+    def test_classify(self):
+        import inspect
+        from .maintenance import CheckKeyringLogs, KeyringLogMatchers
+        methods = [m for name, m in inspect.getmembers(CheckKeyringLogs, lambda x:(inspect.ismethod(x) and hasattr(x, "re")))]
+        matchers = KeyringLogMatchers(methods)
+
+        method, kw = matchers.classify("* Add new DM key 0x0123456789ABCDEF (Test Person) (RT #1234)")
+        self.assertEquals(method.__name__, "do_new_dm")
+        self.assertEquals(kw, dict(key="0123456789ABCDEF", rt="1234"))
+
+        method, kw = matchers.classify("* Replace key 0x0123456789ABCDEF with 0x1123456789ABCDEF (Test Person) (RT #1235)")
+        self.assertEquals(method.__name__, "do_replace")
+        self.assertEquals(kw, dict(key1="0123456789ABCDEF", key2="1123456789ABCDEF", rt="1235"))
+
+        method, kw = matchers.classify("* Update 0x0123456789ABCDEF (RT #1236)")
+        self.assertEquals(method.__name__, "do_fallback")
+
+        self.assertIsNone(matchers.classify("* Update the README"))
@@ -39,7 +39,6 @@ def json_response(val, status_code=200):
     json.dump(val, res, cls=Serializer, indent=1)
     return res
 
-@ratelimit(method="GET", rate="3/m")
 def keycheck(request, fpr):
     """
     Web-based keycheck.sh implementation
@@ -47,37 +46,63 @@ def keycheck(request, fpr):
     if request.method != "GET":
         return http.HttpResponseForbidden("Only GET request is allowed here")
 
+    # Serve the last results without going through the rate limiter. If they
+    # are outdated, mark them as stale and refresh the key in background
+    try:
+        key = kmodels.UserKey(fpr)
+        res, valid = key.keycheck_last()
+        if res:
+            stale = not valid or key.getmtime() + kmodels.KEYSERVER_REFRESH_MAX_AGE < time.time()
+            if stale:
+                kmodels.refresh_queue.enqueue(fpr)
+            k = dict(_pick_result(res, fpr))
+            k["stale"] = stale
+            k["refreshing"] = kmodels.refresh_queue.is_pending(fpr)
+            return json_response(k)
+    except (RuntimeError, EnvironmentError) as e:
+        return json_response({
+            "error": unicode(e)
+        }, status_code=500)
+
+    # Keys never seen before are fetched and checked right away
+    return _keycheck_uncached(request, key)
+
+def _pick_result(res, fpr):
+    """
+    Return the results for the key that was asked for
+    """
+    fpr = fpr.upper()
+    k = res.get(fpr, None)
+    if k is not None: return k
+    # This can happen with old short fingerprints, or if the keyserver sent
+    # more keys: prefer the keys whose fingerprint ends with what was asked,
+    # and choose by fingerprint so that the choice does not change
+    candidates = sorted(f for f in res if f.endswith(fpr)) or sorted(res)
+    return res[candidates[0]]
+
+@ratelimit(method="GET", rate="3/m")
+def _keycheck_uncached(request, key):
     if getattr(request, 'limited', False) and request.user.is_anonymous():
         return json_response({
             "error": "too many requests, please wait a minute before retrying",
         }, status_code=420)
 
     try:
-        key = kmodels.UserKey(fpr)
-        # Do not refresh more than once every 5 minutes
-        if key.getmtime() + 300 < time.time():
-            key.refresh()
-        res = {}
-        for kc in key.keycheck():
-            uids = []
-            k = {
-                "fpr": kc.key.fpr,
-                "errors": sorted(kc.errors),
-                "uids": uids
-            }
-            res[kc.key.fpr] = k
-
-            for ku in kc.uids:
-                uids.append({
-                    "name": ku.uid.name,
-                    "errors": sorted(ku.errors),
-                    "sigs_ok": [x[9].decode("utf8", "replace") for x in ku.sigs_ok],
-                    "sigs_no_key": len(ku.sigs_no_key),
-                    "sigs_bad": len(ku.sigs_bad)
-                })
-
+        # Do not work on the key while it is refreshed in background
+        with kmodels.refresh_queue.key_lock(key.fpr):
+            # Do not refresh more than once every 5 minutes
+            if key.getmtime() + 300 < time.time():
+                key.refresh()
+            res = key.keycheck_results()
+        if not res:
+            return json_response({
+                "error": "key not found",
+            }, status_code=404)
+        k = dict(_pick_result(res, key.fpr))
+        k["stale"] = False
+        k["refreshing"] = False
         return json_response(k)
-    except RuntimeError as e:
+    except (RuntimeError, EnvironmentError) as e:
         return json_response({
             "error": unicode(e)
         }, status_code=500)
@@ -22,6 +22,7 @@ import optparse
 import sys
 import logging
 from minechangelogs import models as mmodels
+import projectb.models as pmodels
 
 log = logging.getLogger(__name__)
 
@@ -30,19 +31,46 @@ class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         optparse.make_option("--quiet", action="store_true", dest="quiet", default=None, help="Disable progress reporting"),
         optparse.make_option("--oldentries", action="store", metavar="FILE", help="Also read old entries from a file"),
+        optparse.make_option("--reindex", action="store_true", default=False,
+                             help="Reindex all entries in projectb, and in --oldentries if given. This happens"
+                                  " automatically when the index was built by an older version"),
+        optparse.make_option("--batch-size", action="store", type="int", dest="batch_size", default=None, metavar="N",
+                             help="Commit the index every N entries (default: %d)" % mmodels.MINECHANGELOGS_BATCH_SIZE),
+        optparse.make_option("--workers", action="store", type="int", default=None, metavar="N",
+                             help="Number of processes analysing changelog entries (default: one per CPU)"),
+        optparse.make_option("--fetch-size", action="store", type="int", dest="fetch_size", default=None, metavar="N",
+                             help="Fetch N rows at a time from projectb, 0 to fetch all at once (default: %d)" % mmodels.MINECHANGELOGS_FETCH_SIZE),
     )
 
-    def handle(self, oldentries=None, **opts):
+    def handle(self, oldentries=None, reindex=False, batch_size=None, workers=None, fetch_size=None, **opts):
         FORMAT = "%(asctime)-15s %(levelname)s %(message)s"
         if opts["quiet"]:
             logging.basicConfig(level=logging.WARNING, stream=sys.stderr, format=FORMAT)
         else:
             logging.basicConfig(level=logging.INFO, stream=sys.stderr, format=FORMAT)
 
-        indexer = mmodels.Indexer()
+        indexer = mmodels.Indexer(batch_size=batch_size, workers=workers)
+        try:
+            self.update(indexer, oldentries, reindex, fetch_size)
+        finally:
+            indexer.close()
+        log.info("projectb connections: %(opened)d opened, %(reused)d reused", pmodels.connection_stats.as_dict())
+
+    def update(self, indexer, oldentries, reindex, fetch_size):
+        if not reindex and indexer.needs_rebuild:
+            log.warning("index built by an older version: reindexing everything")
+            if not oldentries:
+                log.warning("entries previously indexed with --oldentries will not be reindexed")
+            reindex = True
+
         if oldentries:
             indexer.index(mmodels.parse_changelog(oldentries))
 
-        with mmodels.parse_projectb() as changes:
-            indexer.index(changes)
+        # Save the projectb position after each commit, so that an
+        # interrupted run resumes from the last committed batch
+        projectb = mmodels.parse_projectb(fetch_size=fetch_size, reset=reindex)
+        with projectb as changes:
+            indexer.index(changes, checkpoint=projectb.save_state, position=projectb.position)
+        if reindex:
+            indexer.set_terms_version()
         indexer.flush()
@@ -2,19 +2,56 @@ from django.db import models
 from django.conf import settings
 import logging
 import projectb.models as pmodels
-from backend import utils
 import time
 import re
+import itertools
+import collections
+import threading
+import multiprocessing
 import os
 import os.path
 import email.utils
 import cPickle as pickle
+import sqlite3
 import xapian
 
 log = logging.getLogger(__name__)
 
 MINECHANGELOGS_CACHEDIR = getattr(settings, "MINECHANGELOGS_CACHEDIR", "./data/mc_cache")
 MINECHANGELOGS_INDEXDIR = getattr(settings, "MINECHANGELOGS_INDEXDIR", "./data/mc_index")
+# Number of changelog entries indexed between commits
+MINECHANGELOGS_BATCH_SIZE = getattr(settings, "MINECHANGELOGS_BATCH_SIZE", 10000)
+# Number of processes analysing changelog entries; None means one per CPU
+MINECHANGELOGS_INDEX_WORKERS = getattr(settings, "MINECHANGELOGS_INDEX_WORKERS", None)
+# Number of rows fetched at a time from projectb; 0 fetches the whole result
+# set at once
+MINECHANGELOGS_FETCH_SIZE = getattr(settings, "MINECHANGELOGS_FETCH_SIZE", 500)
+# Number of entries per page of search results
+MINECHANGELOGS_PAGE_SIZE = getattr(settings, "MINECHANGELOGS_PAGE_SIZE", 100)
+# Number of search result pages to keep cached in each process
+MINECHANGELOGS_QUERY_CACHE_SIZE = getattr(settings, "MINECHANGELOGS_QUERY_CACHE_SIZE", 256)
+# Number of idle database handles to keep open in each process
+MINECHANGELOGS_DB_POOL_SIZE = getattr(settings, "MINECHANGELOGS_DB_POOL_SIZE", 4)
+# Language used to stem case-folded terms (for example "english"), or None
+# to disable stemming
+MINECHANGELOGS_STEM_LANGUAGE = getattr(settings, "MINECHANGELOGS_STEM_LANGUAGE", None)
+
+# Version of the terms added to documents by the indexer. When it changes,
+# index_changelogs reindexes everything
+TERMS_VERSION = "1"
+
+# Prefix of lowercased terms, indexed with positions so that phrase queries
+# work. Prefixes end with ':' so that they cannot be confused with raw terms
+# starting with uppercase letters
+PREFIX_FOLDED = "XL:"
+# Prefix of stemmed lowercased terms
+PREFIX_STEMMED = "Z:"
+# Prefixes of the boolean terms with the email and the normalised name of
+# the person in Changed-By
+PREFIX_EMAIL = "XE"
+PREFIX_NAME = "XN"
+# Maximum length in bytes of a Xapian term
+MAX_TERM_LENGTH = 240
 
 def parse_changelog(fname):
     """
@@ -46,53 +83,168 @@ def parse_changelog(fname):
     log.info("%s: %d changelog entries found", fname, count)
 
 
+class Checkpoint(object):
+    """
+    Store the position reached reading changes from projectb, in a small
+    sqlite database.
+
+    The position is the last 'seen' timestamp read, and the IDs of the
+    changes already read with that timestamp. Saving only stores what
+    changed since the last save, in a single sqlite transaction.
+    """
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self.db = None
+        # What is currently stored in the database
+        self.seen = None
+        self.ids = set()
+
+    def open(self):
+        # Ensure the cache dir exists
+        dirname = os.path.dirname(self.pathname)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(self.pathname)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS position (seen TEXT NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS seen_ids (id INTEGER PRIMARY KEY)")
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def load(self):
+        """
+        Return the stored position as (seen, ids), or (None, set()) if
+        nothing has been stored yet
+        """
+        if self.db is None: self.open()
+        row = self.db.execute("SELECT seen FROM position").fetchone()
+        if row is None:
+            self.seen = None
+            self.ids = set()
+        else:
+            self.seen = row[0]
+            self.ids = set(r[0] for r in self.db.execute("SELECT id FROM seen_ids"))
+        return self.seen, set(self.ids)
+
+    def save(self, seen, ids):
+        """
+        Store a new position
+        """
+        if seen is None: return
+        if self.db is None: self.open()
+        with self.db:
+            if seen != self.seen:
+                # The boundary moved: the old IDs are not needed anymore
+                self.db.execute("DELETE FROM position")
+                self.db.execute("DELETE FROM seen_ids")
+                self.db.execute("INSERT INTO position (seen) VALUES (?)", (seen,))
+                self.ids = set()
+            new_ids = [(x,) for x in ids if x not in self.ids]
+            if new_ids:
+                self.db.executemany("INSERT OR IGNORE INTO seen_ids (id) VALUES (?)", new_ids)
+        self.seen = seen
+        self.ids.update(x for x, in new_ids)
+
+
 class parse_projectb(object):
     """
-    Extract changelog entries from projectb, checkpointing all the last
-    extracted entries to a pickled cache file.
+    Extract changelog entries from projectb, checkpointing the position of
+    the last extracted entries to a Checkpoint database.
 
     This works as a context manager:
 
         with parse_projectb() as changes:
             for changelog_entry in changes:
                 process(changelog_entry)
+
+    save_state can also be called while the changes are being consumed, to
+    checkpoint the progress so far.
     """
-    def __init__(self, statefile=None):
+    def __init__(self, statefile=None, fetch_size=None, reset=False):
+        """
+        If reset is True, ignore the saved state and read all changes
+        """
         if statefile is None:
-            statefile = os.path.join(MINECHANGELOGS_CACHEDIR, "index-checkpoint.pickle")
+            statefile = os.path.join(MINECHANGELOGS_CACHEDIR, "index-checkpoint.sqlite")
         self.statefile = statefile
+        self.checkpoint = Checkpoint(statefile)
+        self.fetch_size = fetch_size if fetch_size is not None else MINECHANGELOGS_FETCH_SIZE
+        self.reset = reset
 
     def load_state(self):
         """
         Read the last saved state
         """
+        if self.reset:
+            self.state = dict(old_seen=None, old_seen_ids=set())
+            return
+        old_seen, old_seen_ids = self.checkpoint.load()
+        if old_seen is None:
+            old_seen, old_seen_ids = self._load_legacy_state()
+        self.state = dict(old_seen=old_seen, old_seen_ids=old_seen_ids)
+
+    def _load_legacy_state(self):
+        """
+        Read the state from the pickle file used by previous versions
+        """
+        legacy = os.path.join(os.path.dirname(self.statefile), "index-checkpoint.pickle")
         try:
-            with open(self.statefile) as infd:
-                self.state = pickle.load(infd)
+            with open(legacy) as infd:
+                state = pickle.load(infd)
         except IOError:
-            self.state = dict()
+            return None, set()
+        old_seen = state.get("old_seen", None)
+        if old_seen is not None:
+            old_seen = old_seen.isoformat()
+        log.info("%s: resuming from legacy checkpoint", legacy)
+        return old_seen, set(state.get("old_seen_ids", ()))
 
-    def save_state(self):
+    def position(self):
         """
-        Atomically commit the state to disk
+        Return a snapshot of the position reached reading changes, that can
+        later be passed to save_state
         """
-        # Ensure the cache dir exists
-        dirname = os.path.dirname(self.statefile)
-        if not os.path.isdir(dirname):
-            os.makedirs(dirname)
+        return self.state["old_seen"], frozenset(self.state["old_seen_ids"])
 
-        with utils.atomic_writer(self.statefile) as outfd:
-            pickle.dump(self.state, outfd, pickle.HIGHEST_PROTOCOL)
+    def save_state(self, position=None):
+        """
+        Commit the state to disk. If position is given, save it instead of
+        the current state
+        """
+        if position is None:
+            position = self.state["old_seen"], self.state["old_seen_ids"]
+        self.checkpoint.save(*position)
 
     def get_changes(self):
         """
         Produce information about new uploads since the last run
         """
-        cur = pmodels.cursor()
+        # Stream the results with a server side cursor, to avoid loading all
+        # the changelogs in memory when indexing from scratch
+        if self.fetch_size:
+            with pmodels.server_cursor("minechangelogs_changes", self.fetch_size) as cur:
+                for entry in self._get_changes(cur):
+                    yield entry
+        else:
+            cur = pmodels.cursor()
+            try:
+                for entry in self._get_changes(cur):
+                    yield entry
+            finally:
+                cur.close()
 
-        # Read last checkpoint state
-        old_seen = self.state.get("old_seen", None)
-        old_seen_ids = self.state.get("old_seen_ids", [])
+    def _get_changes(self, cur):
+        """
+        Query cur for new uploads and generate changelog entries
+        """
+        # Read last checkpoint state. old_seen is stored in ISO format, which
+        # PostgreSQL understands, and can be compared as a string with the
+        # other values of seen, since they come ordered
+        old_seen = self.state["old_seen"]
+        old_seen_ids = self.state["old_seen_ids"]
 
         # Get the new changes, limited to the newest version
         q = """
@@ -120,10 +272,16 @@ SELECT c.id, c.seen, c.source, c.version,
                 last_year_count = 0
             # Skip the rare cases of partially processed multiple sources on the same instant
             if id in old_seen_ids: continue
-            if old_seen is None or seen > old_seen:
+            seen = seen.isoformat()
+            if seen != old_seen:
                 old_seen = seen
-                old_seen_ids = []
-            old_seen_ids.append(id)
+                old_seen_ids = set()
+            old_seen_ids.add(id)
+
+            # Keep the state current, so that it can be checkpointed while
+            # the stream is being consumed
+            self.state["old_seen"] = old_seen
+            self.state["old_seen_ids"] = old_seen_ids
 
             # Pass on the info to be indexed
             yield "%s_%s" % (source, version), date, changedby, changelog
@@ -140,117 +298,619 @@ SELECT c.id, c.seen, c.source, c.version,
     def __exit__(self, exc_type, exc_val, exc_tb):
         if exc_type is None:
             self.save_state()
+        self.checkpoint.close()
         return False
 
 
+_stemmer = None
+
+def get_stemmer():
+    """
+    Return the xapian.Stem for MINECHANGELOGS_STEM_LANGUAGE, or None if
+    stemming is disabled
+    """
+    global _stemmer
+    if MINECHANGELOGS_STEM_LANGUAGE is None: return None
+    if _stemmer is None:
+        _stemmer = xapian.Stem(MINECHANGELOGS_STEM_LANGUAGE)
+    return _stemmer
+
+def fold_case(s):
+    """
+    Lowercase a term, also when it is an utf8 encoded str
+    """
+    if isinstance(s, str):
+        s = s.decode("utf-8", "replace")
+    return s.lower()
+
+def identity_terms(name, email):
+    """
+    Return the boolean terms identifying a person with the given name and
+    email
+    """
+    res = []
+    if email:
+        res.append(PREFIX_EMAIL + fold_case(email.strip()))
+    if name:
+        name = " ".join(fold_case(name).split())
+        if name:
+            res.append(PREFIX_NAME + name)
+    return [t for t in res if len(t.encode("utf-8")) <= MAX_TERM_LENGTH]
+
+def changedby_terms(changedby):
+    """
+    Return the boolean terms identifying the person in a Changed-By field
+    """
+    try:
+        name, email = pmodels.fix_maintainer(changedby)
+    except ValueError:
+        return []
+    return identity_terms(name, email)
+
+re_split = re.compile(r"[^\w_@.-]+")
+re_ts = re.compile(r"(\w+\s*,\s*\d+\s+\w+\s*\d+\s+\d+:\d+:\d+)")
+
+def analyse_entry(entry):
+    """
+    Turn a (tag, date, changedby, changelog) entry into what is needed to
+    build its Xapian document: (xid, data, sort timestamp, list of terms in
+    position order, list of stemmed terms, list of boolean terms).
+
+    This does all the CPU intensive work of indexing, and is run in worker
+    processes by Indexer.
+    """
+    tag, date, changedby, changelog = entry
+    xid = "XP" + tag
+    data = changelog + "\n" + " -- " + changedby + "  " + date
+    # Ignore timezones for our purposes: dealing with timezones in
+    # python means dealing with one of the most demented pieces of code
+    # people have ever conceived, or otherwise it means introducing
+    # piles of external dependencies that maybe do the job. We can get
+    # away without timezones, it is a lucky thing and we take advantage
+    # of such strokes of luck.
+    ts = 0
+    mo = re_ts.match(date)
+    if mo:
+        parsed = email.utils.parsedate_tz(mo.group(1))
+        if parsed is not None:
+            ts = time.mktime(parsed[:9])
+    terms = []
+    lines = changelog.split("\n")[1:]
+    lines.append(changedby)
+    for l in lines:
+        for tok in re_split.split(l):
+            tok = tok.strip(".-")
+            if not tok: continue
+            # see ircd (2.10.04+-1)
+            if len(tok) > 100: continue
+            if tok.isdigit(): continue
+            terms.append(tok)
+    stemmer = get_stemmer()
+    if stemmer is None:
+        stems = []
+    else:
+        stems = list(set(stemmer(fold_case(t).encode("utf-8")) for t in terms))
+    return xid, data, ts, terms, stems, changedby_terms(changedby)
+
+
 class Indexer(object):
-    def __init__(self):
+    """
+    Index changelog entries, committing every batch_size entries.
+
+    Entries are analysed by a pool of workers processes, while the main
+    process only writes the resulting documents to the database. Reading
+    the input, analysing entries and writing documents all happen at the
+    same time.
+    """
+    # Number of entries sent to a worker at a time
+    WORKER_CHUNK_SIZE = 50
+    # Maximum number of entries read from the input and not yet written
+    READ_AHEAD = 2000
+
+    def __init__(self, batch_size=None, workers=None):
+        self.batch_size = batch_size if batch_size is not None else MINECHANGELOGS_BATCH_SIZE
+        if workers is None:
+            workers = MINECHANGELOGS_INDEX_WORKERS
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        # Start the workers before opening the database, so that they do not
+        # inherit its file descriptors and lock
+        if self.workers > 1:
+            self.pool = multiprocessing.Pool(processes=self.workers)
+        else:
+            self.pool = None
         if not os.path.isdir(MINECHANGELOGS_INDEXDIR):
             os.makedirs(MINECHANGELOGS_INDEXDIR)
         self.xdb = xapian.WritableDatabase(MINECHANGELOGS_INDEXDIR, xapian.DB_CREATE_OR_OPEN)
-        self.xdb.begin_transaction()
-        self.re_split = re.compile(r"[^\w_@.-]+")
-        self.re_ts = re.compile(r"(\w+\s*,\s*\d+\s+\w+\s*\d+\s+\d+:\d+:\d+)")
-        self.max_ts = None
-
-    def tokenise(self, s):
-        return self.re_split.split(s)
-
-    def index(self, entries):
-        count = 0
-        for tag, date, changedby, changelog in entries:
-            count += 1
-            #if count % 1000 == 0:
-            #    print date
-            xid = "XP" + tag
-            document = xapian.Document()
-            document.set_data(changelog + "\n" + " -- " + changedby + "  " + date)
-            #print date
-            # Ignore timezones for our purposes: dealing with timezones in
-            # python means dealing with one of the most demented pieces of code
-            # people have ever conceived, or otherwise it means introducing
-            # piles of external dependencies that maybe do the job. We can get
-            # away without timezones, it is a lucky thing and we take advantage
-            # of such strokes of luck.
-            ts = 0
-            mo = self.re_ts.match(date)
-            if mo:
-                #ts = time.mktime(time.strptime(mo.group(1), "%a, %d %b %Y %H:%M:%S"))
-                parsed = email.utils.parsedate_tz(mo.group(1))
-                if parsed is not None:
-                    ts = time.mktime(parsed[:9])
-            #parsed = dateutil.parser.parse(date)
-            #parsed = email.utils.parsedate_tz(date)
-            #ts = time.mktime(parsed[:9]) - parsed[9]
-            document.add_value(0, xapian.sortable_serialise(ts))
-            document.add_term(xid)
-            pos = 0
-            lines = changelog.split("\n")[1:]
-            lines.append(changedby)
-            for l in lines:
-                for tok in self.tokenise(l):
-                    tok = tok.strip(".-")
-                    if not tok: continue
-                    # see ircd (2.10.04+-1)
-                    if len(tok) > 100: continue
-                    if tok.isdigit(): continue
-                    document.add_posting(tok, pos)
-                    pos += 1
-            self.xdb.replace_document(xid, document)
-            if self.max_ts is None or ts > self.max_ts:
-                self.max_ts = ts
+        # Number of documents indexed since the last commit
+        self.pending = 0
+        max_ts = self.xdb.get_metadata("max_ts")
+        self.max_ts = float(max_ts) if max_ts else None
+        if self.xdb.get_doccount() == 0:
+            # A new index gets all the current terms
+            self.set_terms_version()
 
-    def flush(self):
+    @property
+    def needs_rebuild(self):
         """
-        Flush and save indexing information
+        True if the index has documents indexed with a different version of
+        the terms
+        """
+        return self.xdb.get_metadata("terms_version") != TERMS_VERSION
+
+    def set_terms_version(self):
+        """
+        Record that all documents have the current version of the terms. It
+        is saved at the next commit
+        """
+        self.xdb.set_metadata("terms_version", TERMS_VERSION)
+
+    def index(self, entries, checkpoint=None, position=None):
+        """
+        Index the given (tag, date, changedby, changelog) entries.
+
+        Changes are committed every self.batch_size entries and at the end.
+        After each commit, checkpoint (if given) is called to save the
+        position reached in the input, so that an interrupted run can resume
+        from the last commit.
+
+        position, if given, is called after reading each entry to snapshot
+        the position reached in the input, and the snapshot of the last
+        written entry is passed to checkpoint.
+        """
+        # Positions in the input of the entries read and not yet written,
+        # in order
+        positions = collections.deque()
+        # Limit how far reading the input gets ahead of writing
+        window = threading.Semaphore(self.READ_AHEAD)
+        stop = threading.Event()
+
+        def feed(entries):
+            for entry in entries:
+                positions.append(position() if position is not None else None)
+                yield entry
+                window.acquire()
+                if stop.is_set(): break
+
+        entries = iter(entries)
+        # Read the first entry here, so that an input reading from a database
+        # opens its cursor on the connection of this thread
+        try:
+            first = next(entries)
+        except StopIteration:
+            self.commit(checkpoint)
+            return
+        entries = feed(itertools.chain((first,), entries))
+
+        if self.pool is not None:
+            results = self.pool.imap(analyse_entry, entries, self.WORKER_CHUNK_SIZE)
+        else:
+            results = itertools.imap(analyse_entry, entries)
+
+        last_position = None
+        try:
+            for xid, data, ts, terms, stems, boolean_terms in results:
+                self.add(xid, data, ts, terms, stems, boolean_terms)
+                last_position = positions.popleft()
+                window.release()
+                if self.batch_size and self.pending >= self.batch_size:
+                    self.commit(checkpoint, last_position)
+        except:
+            # Unblock the reader, so that it stops
+            stop.set()
+            for i in xrange(self.READ_AHEAD):
+                window.release()
+            raise
+        self.commit(checkpoint, last_position)
+
+    def add(self, xid, data, ts, terms, stems, boolean_terms):
+        """
+        Add or replace a document with the results of analyse_entry
+        """
+        document = xapian.Document()
+        document.set_data(data)
+        document.add_value(0, xapian.sortable_serialise(ts))
+        document.add_term(xid)
+        for pos, term in enumerate(terms):
+            document.add_posting(term, pos)
+            document.add_posting(PREFIX_FOLDED + fold_case(term), pos)
+        for stem in stems:
+            document.add_term(PREFIX_STEMMED + stem)
+        for term in boolean_terms:
+            document.add_boolean_term(term)
+        self.xdb.replace_document(xid, document)
+        if self.max_ts is None or ts > self.max_ts:
+            self.max_ts = ts
+        self.pending += 1
+
+    def commit(self, checkpoint=None, position=None):
+        """
+        Commit the documents indexed so far together with indexing
+        information, then call checkpoint if given, with position if given
         """
         if self.max_ts is None:
             self.xdb.set_metadata("max_ts", "0")
         else:
             self.xdb.set_metadata("max_ts", str(self.max_ts))
         self.xdb.set_metadata("last_indexed", str(time.time()))
-        self.xdb.commit_transaction()
+        self.xdb.commit()
+        if self.pending:
+            log.info("index: %d entries committed", self.pending)
+        self.pending = 0
+        if checkpoint is not None:
+            if position is None:
+                checkpoint()
+            else:
+                checkpoint(position)
+
+    def flush(self):
+        """
+        Flush and save indexing information
+        """
+        self.commit()
+
+    def close(self):
+        """
+        Stop the worker processes
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+class DatabasePool(object):
+    """
+    Thread-safe pool of open, read-only handles to the index.
+
+    A handle is used by one thread at a time. When taken from the pool it is
+    reopened, which is cheap if the index has not changed since it was last
+    used.
+    """
+    def __init__(self, pathname, size):
+        self.pathname = pathname
+        # Maximum number of idle handles to keep
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reopened = 0
+
+    def acquire(self):
+        """
+        Get a database handle from the pool, opening a new one if needed
+        """
+        with self.lock:
+            if self.idle:
+                xdb = self.idle.pop()
+                self.hits += 1
+            else:
+                xdb = None
+                self.misses += 1
+        if xdb is None:
+            return xapian.Database(self.pathname)
+        if xdb.reopen():
+            with self.lock:
+                self.reopened += 1
+        return xdb
+
+    def release(self, xdb):
+        """
+        Return a database handle to the pool
+        """
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(xdb)
+                return
+        xdb.close()
+
+    def get(self):
+        """
+        Return a context manager that acquires a database handle and
+        releases it on exit
+        """
+        return PooledDatabase(self)
+
+    def stats(self):
+        """
+        Return a dict with the pool counters
+        """
+        with self.lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                reopened=self.reopened,
+                idle=len(self.idle),
+            )
+
+class PooledDatabase(object):
+    """
+    Context manager for a database handle from a DatabasePool
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.xdb = None
+
+    def __enter__(self):
+        self.xdb = self.pool.acquire()
+        return self.xdb
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.pool.release(self.xdb)
+        self.xdb = None
+        return False
+
+db_pool = DatabasePool(MINECHANGELOGS_INDEXDIR, MINECHANGELOGS_DB_POOL_SIZE)
 
 def info():
     """
     Get information about the state of the minechangelogs database
     """
-    xdb = xapian.Database(MINECHANGELOGS_INDEXDIR)
-    return dict(
-        max_ts = float(xdb.get_metadata("max_ts")),
-        last_indexed = float(xdb.get_metadata("last_indexed")),
-    )
+    with db_pool.get() as xdb:
+        return dict(
+            max_ts = float(xdb.get_metadata("max_ts")),
+            last_indexed = float(xdb.get_metadata("last_indexed")),
+            current_terms = xdb.get_metadata("terms_version") == TERMS_VERSION,
+        )
 
-def query(keywords):
+def has_current_terms():
     """
-    Get changelog entries matching the given keywords
+    Check if the index has the case-folded and identity terms, that is, if
+    it has been indexed with the current TERMS_VERSION
     """
-    xdb = xapian.Database(MINECHANGELOGS_INDEXDIR)
+    with db_pool.get() as xdb:
+        return xdb.get_metadata("terms_version") == TERMS_VERSION
 
+def _make_query(keywords, ignore_case=False):
+    """
+    Build a xapian query matching any of the given keywords, or None if
+    there are no keywords.
+
+    If ignore_case is True, match the case-folded terms, and the stemmed
+    terms if stemming is enabled.
+    """
+    stemmer = get_stemmer() if ignore_case else None
     q = None
     for a in keywords:
         a = a.strip()
         if not a: continue
-        if ' ' in a:
-            a = a.split()
-            p = xapian.Query(xapian.Query.OP_PHRASE, a)
+        if ignore_case:
+            terms = [PREFIX_FOLDED + fold_case(t) for t in a.split()]
         else:
-            p = xapian.Query(a)
+            terms = a.split()
+        if len(terms) > 1:
+            p = xapian.Query(xapian.Query.OP_PHRASE, terms)
+        else:
+            p = xapian.Query(terms[0])
+            if stemmer is not None:
+                stem = stemmer(fold_case(a).encode("utf-8"))
+                p = xapian.Query(xapian.Query.OP_OR, p, xapian.Query(PREFIX_STEMMED + stem))
         if q is None:
             q = p
         else:
             q = xapian.Query(xapian.Query.OP_OR, q, p)
-    if q is None: return
+    return q
 
+def _make_enquire(xdb, q, order="date"):
+    """
+    Create an Enquire for the query q.
+
+    order can be "date", for newest entries first, or "relevance".
+    """
     enquire = xapian.Enquire(xdb)
     enquire.set_query(q)
-    enquire.set_sort_by_value(0, True)
-
-    first = 0
-    while True:
-        matches = enquire.get_mset(first, 100)
-        count = matches.size()
-        if count == 0: break
-        for m in matches:
-            yield m.document.get_data()
-        first += 100
+    if order == "date":
+        enquire.set_sort_by_value(0, True)
+    elif order == "relevance":
+        enquire.set_sort_by_relevance_then_value(0, True)
+    else:
+        raise ValueError("unsupported result order %r" % order)
+    return enquire
+
+def query(keywords, order="date", ignore_case=False):
+    """
+    Get changelog entries matching the given keywords.
+
+    If ignore_case is True, keywords match regardless of case, unless the
+    index has not been rebuilt with the case-folded terms yet.
+    """
+    if ignore_case and not has_current_terms():
+        ignore_case = False
+    q = _make_query(keywords, ignore_case)
+    if q is None: return
+
+    with db_pool.get() as xdb:
+        enquire = _make_enquire(xdb, q, order)
+
+        first = 0
+        while True:
+            matches = enquire.get_mset(first, 100)
+            count = matches.size()
+            if count == 0: break
+            for m in matches:
+                yield m.document.get_data()
+            first += 100
+
+
+class ResultPage(object):
+    """
+    A page of results from a minechangelogs search
+    """
+    def __init__(self, entries, offset, limit, matches_estimated, matches_lower_bound=None):
+        self.entries = entries
+        self.offset = offset
+        self.limit = limit
+        self.matches_estimated = matches_estimated
+        if matches_lower_bound is None:
+            matches_lower_bound = offset + len(entries)
+        self.matches_lower_bound = matches_lower_bound
+
+    def get_matches_estimated(self):
+        """
+        Estimated total number of matching entries
+        """
+        return self.matches_estimated
+
+    @property
+    def first(self):
+        """
+        1-based position of the first entry in the page
+        """
+        return self.offset + 1 if self.entries else 0
+
+    @property
+    def last(self):
+        """
+        1-based position of the last entry in the page
+        """
+        return self.offset + len(self.entries)
+
+    @property
+    def page(self):
+        """
+        1-based number of this page
+        """
+        return self.offset // self.limit + 1
+
+    @property
+    def has_previous(self):
+        return self.offset > 0
+
+    @property
+    def has_next(self):
+        return self.matches_lower_bound > self.offset + self.limit
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+class QueryCache(object):
+    """
+    LRU cache of search results, valid for one revision of the index.
+
+    Keys are looked up together with the index revision: when the revision
+    changes, all cached results are discarded.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.revision = None
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, revision, key):
+        with self.lock:
+            if revision != self.revision:
+                self.entries.clear()
+                self.revision = revision
+                return None
+            res = self.entries.pop(key, None)
+            if res is not None:
+                # Move to the end, as most recently used
+                self.entries[key] = res
+            return res
+
+    def put(self, revision, key, value):
+        with self.lock:
+            if revision != self.revision:
+                self.entries.clear()
+                self.revision = revision
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+query_cache = QueryCache(MINECHANGELOGS_QUERY_CACHE_SIZE)
+
+def normalise_keywords(keywords):
+    """
+    Normalise a keyword list into a tuple that can be used as a cache key
+    for queries that match any of the keywords
+    """
+    res = set()
+    for k in keywords:
+        k = " ".join(k.split())
+        if not k: continue
+        res.add(k)
+    return tuple(sorted(res))
+
+def _search(key, make_query, offset, limit, order):
+    """
+    Run a query and return a ResultPage, caching the IDs of the results.
+
+    key identifies the query in the cache, and make_query is called to
+    build the xapian query if it is not cached.
+
+    If offset is past the end of the results, the last page is returned.
+    """
+    with db_pool.get() as xdb:
+        # last_indexed changes at every commit of the index
+        revision = xdb.get_metadata("last_indexed")
+        key = key + (order, offset, limit)
+        cached = query_cache.get(revision, key)
+        if cached is None:
+            enquire = _make_enquire(xdb, make_query(), order)
+            # Check one more document than needed, so that the lower bound
+            # tells if there is a next page
+            matches = enquire.get_mset(offset, limit, offset + limit + 1)
+            lower_bound = matches.get_matches_lower_bound()
+            if matches.empty() and offset > 0 and lower_bound > 0:
+                # Past the end: since fewer documents than checked match,
+                # the lower bound is the exact count
+                offset = (lower_bound - 1) // limit * limit
+                matches = enquire.get_mset(offset, limit, offset + limit + 1)
+                lower_bound = matches.get_matches_lower_bound()
+            cached = (offset, [m.docid for m in matches], matches.get_matches_estimated(), lower_bound)
+            query_cache.put(revision, key, cached)
+        offset, docids, matches_estimated, matches_lower_bound = cached
+        return ResultPage(
+            [xdb.get_document(docid).get_data() for docid in docids],
+            offset, limit, matches_estimated, matches_lower_bound)
+
+def search(keywords, offset=0, limit=None, order="date", ignore_case=False):
+    """
+    Get a ResultPage with at most limit changelog entries matching the given
+    keywords, starting from offset.
+
+    order can be "date", for newest entries first, or "relevance".
+
+    If ignore_case is True, keywords match regardless of case. If the index
+    has not been rebuilt with the case-folded terms yet, matching is
+    case-sensitive.
+    """
+    if ignore_case and not has_current_terms():
+        ignore_case = False
+    if limit is None:
+        limit = MINECHANGELOGS_PAGE_SIZE
+    keywords = normalise_keywords(keywords)
+    if not keywords:
+        return ResultPage([], offset, limit, 0)
+    return _search(("keywords", keywords, ignore_case),
+                   lambda: _make_query(keywords, ignore_case),
+                   offset, limit, order)
+
+def query_person(person, offset=0, limit=None, order="date"):
+    """
+    Get a ResultPage with the changelog entries whose Changed-By matches the
+    name or one of the emails of a Person.
+
+    If the index has not been rebuilt with the identity terms yet, search
+    for the name, email and uid as keywords instead.
+    """
+    if not has_current_terms():
+        keywords = [person.fullname, person.email]
+        if person.uid: keywords.append(person.uid)
+        return search(keywords, offset, limit, order)
+    if limit is None:
+        limit = MINECHANGELOGS_PAGE_SIZE
+    terms = set(identity_terms(person.fullname, person.email))
+    if person.uid:
+        terms.update(identity_terms(None, "%s@debian.org" % person.uid))
+    terms = tuple(sorted(terms))
+    if not terms:
+        return ResultPage([], offset, limit, 0)
+    return _search(("person", terms),
+                   lambda: xapian.Query(xapian.Query.OP_OR, list(terms)),
+                   offset, limit, order)
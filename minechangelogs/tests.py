@@ -6,6 +6,10 @@ Replace this with more appropriate tests for your application.
 """
 
 from django.test import TestCase
+from backend.utils import NamedTemporaryDirectory
+from . import models as mmodels
+import os.path
+import xapian
 
 
 class SimpleTest(TestCase):
@@ -14,3 +18,127 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class OldIndexTest(TestCase):
+    """
+    Query an index built before the case-folded terms were added
+    """
+    def setUp(self):
+        self.tmpdir = NamedTemporaryDirectory()
+        self.orig = mmodels.MINECHANGELOGS_INDEXDIR, mmodels.db_pool, mmodels.query_cache
+        mmodels.MINECHANGELOGS_INDEXDIR = self.tmpdir.__enter__()
+        mmodels.db_pool = mmodels.DatabasePool(mmodels.MINECHANGELOGS_INDEXDIR, 1)
+        mmodels.query_cache = mmodels.QueryCache(10)
+
+        # Only raw terms, and no terms_version
+        xdb = xapian.WritableDatabase(mmodels.MINECHANGELOGS_INDEXDIR, xapian.DB_CREATE_OR_OPEN)
+        doc = xapian.Document()
+        doc.set_data("foo (1.0) unstable; urgency=low\n\n  * Fixed Typo")
+        doc.add_value(0, xapian.sortable_serialise(0))
+        for pos, term in enumerate(("Fixed", "Typo")):
+            doc.add_posting(term, pos)
+        xdb.replace_document("XPfoo_1.0", doc)
+        xdb.set_metadata("max_ts", "0")
+        xdb.set_metadata("last_indexed", "0")
+        xdb.commit()
+        xdb.close()
+
+    def tearDown(self):
+        mmodels.MINECHANGELOGS_INDEXDIR, mmodels.db_pool, mmodels.query_cache = self.orig
+        self.tmpdir.__exit__(None, None, None)
+
+    def test_ignore_case(self):
+        self.assertFalse(mmodels.has_current_terms())
+        self.assertFalse(mmodels.info()["current_terms"])
+        # Matching falls back to case-sensitive both for searches and
+        # downloads
+        self.assertEquals(len(mmodels.search(["Typo"], ignore_case=True)), 1)
+        self.assertEquals(len(list(mmodels.query(["Typo"], ignore_case=True))), 1)
+        self.assertEquals(len(list(mmodels.query(["typo"], ignore_case=True))), 0)
+
+
+class CheckpointTest(TestCase):
+    def test_resume(self):
+        with NamedTemporaryDirectory() as pathname:
+            fname = os.path.join(pathname, "checkpoint.sqlite")
+            cp = mmodels.Checkpoint(fname)
+            self.assertEquals(cp.load(), (None, set()))
+            # Nothing is saved until there is a position
+            cp.save(None, set())
+            cp.save("2014-01-01T00:00:00", set([1, 2]))
+            cp.save("2014-01-01T00:00:00", set([1, 2, 3]))
+            cp.close()
+
+            cp = mmodels.Checkpoint(fname)
+            self.assertEquals(cp.load(), ("2014-01-01T00:00:00", set([1, 2, 3])))
+            # Moving past the timestamp forgets the IDs seen with it
+            cp.save("2014-01-02T00:00:00", set([4]))
+            cp.close()
+
+            cp = mmodels.Checkpoint(fname)
+            self.assertEquals(cp.load(), ("2014-01-02T00:00:00", set([4])))
+            cp.close()
+
+    def test_parse_projectb_state(self):
+        with NamedTemporaryDirectory() as pathname:
+            fname = os.path.join(pathname, "checkpoint.sqlite")
+            cp = mmodels.Checkpoint(fname)
+            cp.save("2014-01-01T00:00:00", set([1]))
+            cp.close()
+
+            # The saved position is resumed
+            changes = mmodels.parse_projectb(statefile=fname)
+            changes.load_state()
+            self.assertEquals(changes.state["old_seen"], "2014-01-01T00:00:00")
+            self.assertEquals(changes.state["old_seen_ids"], set([1]))
+
+            # A position snapshot is saved instead of the current state
+            position = changes.position()
+            changes.state["old_seen"] = "2014-01-03T00:00:00"
+            changes.state["old_seen_ids"] = set([5])
+            changes.save_state(position)
+            changes.checkpoint.close()
+            cp = mmodels.Checkpoint(fname)
+            self.assertEquals(cp.load(), ("2014-01-01T00:00:00", set([1])))
+            cp.close()
+
+            # Reset ignores the saved position
+            changes = mmodels.parse_projectb(statefile=fname, reset=True)
+            changes.load_state()
+            self.assertIsNone(changes.state["old_seen"])
+            self.assertEquals(changes.state["old_seen_ids"], set())
+            changes.checkpoint.close()
+
+
+class IndexerCheckpointTest(TestCase):
+    def setUp(self):
+        self.tmpdir = NamedTemporaryDirectory()
+        self.orig = mmodels.MINECHANGELOGS_INDEXDIR
+        mmodels.MINECHANGELOGS_INDEXDIR = self.tmpdir.__enter__()
+
+    def tearDown(self):
+        mmodels.MINECHANGELOGS_INDEXDIR = self.orig
+        self.tmpdir.__exit__(None, None, None)
+
+    def test_checkpoint_after_commit(self):
+        entries = [("foo_1.%d" % i, "Mon, 01 Jan 2001 00:00:00 +0000", "Foo Bar <foo@example.org>",
+                    "foo (1.%d) unstable; urgency=low\n\n  * Change %d\n" % (i, i)) for i in range(5)]
+        state = dict(position=None)
+        def read():
+            for idx, entry in enumerate(entries):
+                state["position"] = idx
+                yield entry
+
+        saved = []
+        def checkpoint(position):
+            # When the position is saved, the entries up to it are committed
+            xdb = xapian.Database(mmodels.MINECHANGELOGS_INDEXDIR)
+            saved.append((position, xdb.get_doccount()))
+
+        indexer = mmodels.Indexer(batch_size=2, workers=1)
+        try:
+            indexer.index(read(), checkpoint=checkpoint, position=lambda: state["position"])
+        finally:
+            indexer.close()
+        self.assertEquals(saved, [(1, 2), (3, 4), (4, 5)])
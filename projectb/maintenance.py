@@ -20,8 +20,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 from django_maintenance import MaintenanceTask
-from backend.maintenance import MakeLink
-import backend.models as bmodels
+from backend.maintenance import MakeLink, People
 from backend import const
 from . import models as pmodels
 import logging
@@ -32,7 +31,7 @@ class CheckDMList(MaintenanceTask):
     """
     Show entries that do not match between projectb DM list and out DB
     """
-    DEPENDS = [MakeLink]
+    DEPENDS = [MakeLink, People]
 
     def run(self):
         # Code used to import DMs is at 64a3e35a5c55aa3ee122e6234ad24c74a57dd843
@@ -45,12 +44,12 @@ class CheckDMList(MaintenanceTask):
                          self.IDENTIFIER, self.maint.link(p), p.status)
 
         for maint in maints.db.itervalues():
-            person = bmodels.Person.lookup(maint["fpr"])
+            person = self.maint.people.lookup(maint["fpr"])
             if person is not None:
                 check_status(person)
                 continue
 
-            person = bmodels.Person.lookup(maint["email"])
+            person = self.maint.people.lookup(maint["email"])
             if person is not None:
                 log.info("%s: %s matches by email %s with projectb but not by key fingerprint",
                          self.IDENTIFIER, self.maint.link(person), maint["email"])
@@ -59,3 +58,6 @@ class CheckDMList(MaintenanceTask):
 
             log.info("%s: %s/%s exists in projectb but not in our DB",
                      self.IDENTIFIER, maint["email"], maint["fpr"])
+
+        log.debug("%s: projectb connections: %d opened, %d reused",
+                  self.IDENTIFIER, pmodels.connection_stats.opened, pmodels.connection_stats.reused)
@@ -0,0 +1,103 @@
+# coding: utf-8
+# nm.debian.org projectb maintainer matching benchmark
+#
+# Copyright (C) 2014  Enrico Zini <enrico@debian.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+from django.core.management.base import BaseCommand
+import optparse
+import random
+import time
+import sys
+import logging
+import projectb.models as pmodels
+
+log = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = "Time matching DM records to projectb maintainer names, as done by Maintainers.approx_match"
+    option_list = BaseCommand.option_list + (
+        optparse.make_option("--quiet", action="store_true", dest="quiet", default=None, help="Disable progress reporting"),
+        optparse.make_option("--maintainers", action="store", type="int", default=20000, help="Number of maintainer rows (default: %default)"),
+        optparse.make_option("--dms", action="store", type="int", default=500, help="Number of DM records (default: %default)"),
+    )
+
+    def make_data(self, maintainers, dms):
+        """
+        Generate maintainer rows and DM records with projectb-like sizes
+        """
+        rows = []
+        for i in xrange(maintainers):
+            rows.append((i, "Maintainer %d <maint%d@example.org>" % (i, i)))
+        recs = []
+        for i in xrange(dms):
+            # Most DMs match a maintainer by email, some only by name, some
+            # do not match at all
+            idx = random.randrange(maintainers * 2)
+            if i % 3 == 0:
+                recs.append(dict(pdb_u_uid=None, pdb_u_name="Maintainer %d" % idx))
+            else:
+                recs.append(dict(pdb_u_uid="maint%d@example.org" % idx, pdb_u_name=None))
+        return rows, recs
+
+    def scan(self, rows, recs):
+        """
+        Match records scanning all maintainer rows for each record, as
+        approx_match used to do
+        """
+        res = 0
+        for rec in recs:
+            found = None
+            for id, name in rows:
+                (name, email) = pmodels.fix_maintainer(name)
+                if email == rec["pdb_u_uid"] or name == rec["pdb_u_name"]:
+                    found = id
+            if found is not None:
+                res += 1
+        return res
+
+    def indexed(self, rows, recs):
+        """
+        Match records with a DakNames index
+        """
+        names = pmodels.DakNames(rows)
+        res = 0
+        for rec in recs:
+            if names.match(rec["pdb_u_name"], rec["pdb_u_uid"]) is not None:
+                res += 1
+        return res
+
+    def handle(self, quiet=False, maintainers=20000, dms=500, **opts):
+        FORMAT = "%(asctime)-15s %(levelname)s %(message)s"
+        if quiet:
+            logging.basicConfig(level=logging.WARNING, stream=sys.stderr, format=FORMAT)
+        else:
+            logging.basicConfig(level=logging.INFO, stream=sys.stderr, format=FORMAT)
+
+        rows, recs = self.make_data(maintainers, dms)
+
+        results = []
+        for name, func in (("scan", self.scan), ("indexed", self.indexed)):
+            log.info("%s: matching %d records against %d maintainers...", name, len(recs), len(rows))
+            start = time.time()
+            matched = func(rows, recs)
+            elapsed = time.time() - start
+            results.append(elapsed)
+            print("{}: {} records, {} matched, {:.2f}s".format(name, len(recs), matched, elapsed))
+        print("speedup: {:.1f}x".format(results[0] / results[1]))
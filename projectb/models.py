@@ -6,6 +6,7 @@ We mainly use it to make a list of DMs
 
 from django.db import models
 from django.db import connections
+from django.db.backends.signals import connection_created
 from django.conf import settings
 
 import datetime
@@ -13,21 +14,118 @@ import sys
 import os, os.path
 import re
 import time
-import subprocess
+import threading
+from contextlib import contextmanager
 import cPickle as pickle
-import psycopg2
+from keyring import openpgp
+from backend import utils
 import logging
 
 log = logging.getLogger(__name__)
 
+# Maximum run time in milliseconds of statements sent to projectb, or 0 for
+# no limit
+STATEMENT_TIMEOUT = getattr(settings, "PROJECTB_STATEMENT_TIMEOUT", 30 * 60 * 1000)
+
+class ConnectionStats(object):
+    """
+    Count how many times a projectb connection was opened, and how many
+    times an already open one was reused
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def count(self, opened):
+        with self.lock:
+            if opened:
+                self.opened += 1
+            else:
+                self.reused += 1
+
+    def as_dict(self):
+        with self.lock:
+            return dict(opened=self.opened, reused=self.reused)
+
+connection_stats = ConnectionStats()
+
+def _setup_connection(sender, connection, **kw):
+    """
+    Configure new connections to projectb
+    """
+    if connection.alias != "projectb": return
+    connection_stats.count(True)
+    if STATEMENT_TIMEOUT:
+        cur = connection.connection.cursor()
+        cur.execute("SET statement_timeout = %s", (STATEMENT_TIMEOUT,))
+        cur.close()
+        # Commit, or a rollback would undo the setting
+        connection.connection.commit()
+
+connection_created.connect(_setup_connection, dispatch_uid="projectb_setup_connection")
+
+def connection():
+    """
+    Return the psycopg2 connection to projectb.
+
+    All access to projectb goes through the Django 'projectb' database
+    connection, which is kept open and reused by all code running in the
+    same thread.
+    """
+    conn = connections['projectb']
+    if conn.connection is None:
+        # Connect; the connection_created handler counts it
+        conn.cursor()
+    else:
+        connection_stats.count(False)
+    return conn.connection
+
 def cursor():
     """
     Return a Django sane-dbapi-style db cursor to the projectb database
     """
-    return connections['projectb'].cursor()
+    conn = connections['projectb']
+    if conn.connection is not None:
+        connection_stats.count(False)
+    return conn.cursor()
+
+@contextmanager
+def server_cursor(name, fetch_size=2000):
+    """
+    Context manager giving a server-side (named) psycopg2 cursor to the
+    projectb database.
+
+    Iterating it fetches fetch_size rows at a time from the server, instead
+    of transferring the whole result set before the first row is returned.
+    The cursor lives in its own transaction, which is ended when leaving the
+    context, so that the server can release the snapshot and the result.
+    """
+    conn = connection()
+    # Named cursors only exist inside a transaction
+    autocommit = conn.autocommit
+    if autocommit:
+        conn.autocommit = False
+    cur = conn.cursor(name)
+    cur.itersize = fetch_size
+    try:
+        yield cur
+    except:
+        cur.close()
+        conn.rollback()
+        raise
+    else:
+        cur.close()
+        conn.commit()
+    finally:
+        if autocommit:
+            conn.autocommit = True
 
 
 CACHE_FILE="make-dm-list.cache"
+# Location and maximum age in seconds of the cache of DM information
+DM_CACHE = os.path.abspath(getattr(settings, "PROJECTB_DM_CACHE", CACHE_FILE))
+DM_CACHE_MAX_AGE = getattr(settings, "PROJECTB_DM_CACHE_MAX_AGE", 3600 * 12)
 
 KEYRINGS = getattr(settings, "KEYRINGS", "/srv/keyring.debian.org/keyrings")
 
@@ -64,17 +162,21 @@ def fix_maintainer(maintainer):
     return name, email
 
 def read_gpg():
-    "Read DM info from the DB keyring"
+    "Read DM info from the DM keyring"
     keyring = os.path.join(KEYRINGS, "debian-maintainers.gpg")
     re_email = re.compile(r"<(.+?)>")
     re_unmangle = re.compile(r"\\x([0-9A-Fa-f][0-9A-Fa-f])")
-    proc = subprocess.Popen(["/usr/bin/gpg", "--no-permission-warning", "--with-colons", "--with-fingerprint", "--no-default-keyring", "--keyring", keyring, "--list-keys"], stdout=subprocess.PIPE)
     rec = None
-    for line in proc.stdout:
-        if line.startswith("pub:"):
+    for row in openpgp.list_keys(keyring):
+        if row[0] == "pub":
             if rec is not None: yield rec
-            row = line.strip().split(":")
-            # Unmangle gpg output
+            date = datetime.datetime.utcfromtimestamp(int(row[5])).strftime("%Y-%m-%d")
+            rec = dict(sz=int(row[2]), id=row[4], date=date)
+        elif row[0] == "fpr":
+            rec["fpr"] = row[9]
+        elif row[0] == "uid" and "uid" not in rec:
+            # The first uid is the primary one
+            # Unmangle gpg-style escapes
             uid = re_unmangle.sub(lambda mo: chr(int(mo.group(1), 16)), row[9])
             uid = uid.decode("utf-8", "replace")
             mo = re_email.search(uid)
@@ -82,38 +184,150 @@ def read_gpg():
                 email = mo.group(1)
             else:
                 email = uid
-            rec = dict(sz=int(row[2]), id=row[4], date=row[5], uid=uid, email=email)
-        elif line.startswith("fpr:"):
-            row = line.strip().split(":")
-            rec["fpr"] = row[9]
+            rec["uid"] = uid
+            rec["email"] = email
     if rec is not None: yield rec
-    if proc.wait() != 0:
-        raise RuntimeError, "gpg exited with error %d" % proc.returncode
+
+class DakNames(object):
+    """
+    Index of projectb maintainer names, parsed with fix_maintainer, by name
+    and by email
+    """
+    def __init__(self, rows):
+        """
+        rows is a sequence of (id, name) pairs from the maintainer table
+        """
+        # Map names and emails to (position, (id, name, email)). If more than
+        # one row matches, the last one wins, as it did when matching by
+        # scanning all rows in order
+        self.by_name = dict()
+        self.by_email = dict()
+        for pos, (id, name) in enumerate(rows):
+            try:
+                name, email = fix_maintainer(name)
+            except ValueError:
+                log.debug("projectb: skipping unparsable maintainer %d %r", id, name)
+                continue
+            entry = (pos, (id, name, email))
+            self.by_name[name] = entry
+            self.by_email[email] = entry
+
+    def match(self, name, email):
+        """
+        Return (id, name, email) for the last maintainer row matching either
+        name or email, or None if nothing matches
+        """
+        by_name = self.by_name.get(name, None)
+        by_email = self.by_email.get(email, None)
+        if by_name is None and by_email is None: return None
+        return max(x for x in (by_name, by_email) if x is not None)[1]
+
 
 class Maintainers(object):
-    def __init__(self):
-        self.conn = psycopg2.connect("service=projectb")
-        self.conn.set_client_encoding('UTF-8')
+    """
+    Information about DMs from the DM keyring and projectb.
+
+    The information is cached in a pickle file shared by all processes.
+    After PROJECTB_DM_CACHE_MAX_AGE seconds it is rebuilt from projectb,
+    before that, changes in the DM keyring are merged in by only querying
+    projectb for the new fingerprints.
+    """
+    # Version of the cache file format, to be increased when the contents of
+    # the cached records change
+    CACHE_VERSION = 1
+
+    def __init__(self, cachefile=None, max_age=None):
+        self.cachefile = cachefile if cachefile is not None else DM_CACHE
+        self.max_age = max_age if max_age is not None else DM_CACHE_MAX_AGE
+        self.conn = connection()
         self.db = dict()
         self.dak_names = None
-        if os.path.exists(CACHE_FILE) and os.path.getmtime(CACHE_FILE) > time.time() - 3600*12:
-            self.load_from_pickle()
-            self.timestamp = datetime.datetime.fromtimestamp(os.path.getmtime(CACHE_FILE))
-        else:
+        cache = self.load_from_pickle()
+        if cache is None or cache["timestamp"] < time.time() - self.max_age:
             self.load_from_db()
-            self.timestamp = datetime.datetime.now()
+        elif cache["keyring"] != self.keyring_stamp():
+            self.refresh()
+        self.timestamp = datetime.datetime.fromtimestamp(self.db_timestamp)
+
+    def keyring_stamp(self):
+        """
+        Return a value that changes when the DM keyring changes
+        """
+        try:
+            st = os.stat(os.path.join(KEYRINGS, "debian-maintainers.gpg"))
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
 
     def load_from_pickle(self):
+        """
+        Load the cached information. Returns the cache contents, or None if
+        the cache is missing, unreadable or has a different version
+        """
+        try:
+            with open(self.cachefile) as fd:
+                cache = pickle.load(fd)
+        except IOError:
+            return None
+        except Exception as e:
+            log.warn("projectb: %s: cannot read cache, ignoring it: %s", self.cachefile, e)
+            return None
+        if not isinstance(cache, dict) or cache.get("version", None) != self.CACHE_VERSION:
+            log.info("projectb: %s: cache has an old format, ignoring it", self.cachefile)
+            return None
         log.info("projectb: load from cache...")
-        self.db = pickle.load(open(CACHE_FILE))
+        self.db = cache["db"]
+        self.db_timestamp = cache["timestamp"]
+        return cache
 
     def save_to_pickle(self):
-        pickle.dump(self.db, open(CACHE_FILE, "w"))
+        cache = dict(
+            version=self.CACHE_VERSION,
+            timestamp=self.db_timestamp,
+            keyring=self.keyring_stamp(),
+            db=self.db,
+        )
+        with utils.atomic_writer(self.cachefile) as fd:
+            pickle.dump(cache, fd, pickle.HIGHEST_PROTOCOL)
 
     def load_from_db(self):
         log.info("projectb: initialise from the keyring...")
+        self.db = dict()
         for rec in read_gpg():
             self.db[rec["fpr"]] = rec
+        self.db_timestamp = time.time()
+        self.load_pdb_info(self.db.values())
+        self.save_to_pickle()
+
+    def refresh(self):
+        """
+        Merge in changes in the DM keyring, querying projectb only for the
+        fingerprints that were not there before
+        """
+        log.info("projectb: refresh from the keyring...")
+        old = self.db
+        self.db = dict()
+        added = []
+        for rec in read_gpg():
+            cached = old.get(rec["fpr"], None)
+            if cached is None:
+                added.append(rec)
+            else:
+                cached.update(rec)
+                rec = cached
+            self.db[rec["fpr"]] = rec
+        log.info("projectb: %d keys added, %d keys removed",
+                 len(added), len(old.viewkeys() - self.db.viewkeys()))
+        if added:
+            self.load_pdb_info(added)
+        self.save_to_pickle()
+
+    def load_pdb_info(self, recs):
+        """
+        Fill in projectb information for the given records
+        """
+        by_fpr = dict((rec["fpr"], rec) for rec in recs)
+        if not by_fpr: return
 
         log.info("projectb: add fingerprint, uid and maintainer IDs...")
         cur = self.conn.cursor()
@@ -121,23 +335,21 @@ class Maintainers(object):
         SELECT f.fingerprint, f.id, f.uid, m.id
           FROM fingerprint as f, maintainer as m, uid as u
          WHERE f.uid = u.id
-           AND m.name LIKE '% <' || u.uid || '>'
-        """)
+           AND m.name LIKE '%% <' || u.uid || '>'
+           AND f.fingerprint = ANY(%s)
+        """, (list(by_fpr.keys()),))
         for row in cur:
-            rec = self.db.get(row[0], None)
+            rec = by_fpr.get(row[0], None)
             if rec is None: continue
             rec["pdb_fid"] = row[1]
             rec["pdb_uid"] = row[2]
             rec["pdb_mid"] = row[3]
 
         log.info("projectb: validate info and fill in the blanks...")
-        self.validate()
+        self.validate(by_fpr.itervalues())
 
         log.info("projectb: load source package information...")
-        for rec in self.db.itervalues():
-            rec["sources"] = set(self.get_sources(rec))
-
-        self.save_to_pickle()
+        self.load_sources(by_fpr.itervalues())
 
     def approx_match(self, rec):
         """
@@ -170,28 +382,65 @@ class Maintainers(object):
             rec["pdb_u_name"] = row[3]
 
         # Do what dak does to look for maintainer IDs
-        if not self.dak_names:
+        if self.dak_names is None:
             cur.execute("""
             SELECT id, name
               FROM maintainer
              WHERE name like '%@%'
             """)
-            self.dak_names = list(cur)
-        for id, name in self.dak_names:
-            (name, email) = fix_maintainer(name)
-            if email == rec["pdb_u_uid"] or name == rec["pdb_u_name"]:
-                rec["pdb_m_name"] = name
-                rec["pdb_m_email"] = email
-                rec["pdb_mid"] = id
-
-    def validate(self):
-        for rec in self.db.itervalues():
+            self.dak_names = DakNames(cur)
+        match = self.dak_names.match(rec["pdb_u_name"], rec["pdb_u_uid"])
+        if match is not None:
+            rec["pdb_mid"], rec["pdb_m_name"], rec["pdb_m_email"] = match
+
+    def validate(self, recs=None):
+        if recs is None:
+            recs = self.db.itervalues()
+        for rec in recs:
             rec["warn_maintmap"] = \
                rec.get("pdb_fid", None) is None or \
                rec.get("pdb_uid", None) is None or \
                rec.get("pdb_mid", None) is None
             self.approx_match(rec)
 
+    def load_sources(self, recs=None):
+        """
+        Fill in rec["sources"] for the given records (by default, all of
+        them), with the source packages that each DM can upload, using a
+        single query
+        """
+        if recs is None:
+            recs = self.db.itervalues()
+        by_mid = dict()
+        for rec in recs:
+            rec["sources"] = set()
+            mid = rec.get("pdb_mid", None)
+            if mid is None: continue
+            by_mid.setdefault(mid, []).append(rec)
+        if not by_mid: return
+
+        # A DM can upload a source if they are listed in the Uploaders of a
+        # DM-Upload-Allowed version of it, and if the latest version of the
+        # source is also DM-Upload-Allowed
+        cur = self.conn.cursor()
+        cur.execute("""
+        WITH latest AS (
+            SELECT DISTINCT ON (source) source, dm_upload_allowed
+              FROM source
+             ORDER BY source, version DESC
+        )
+        SELECT DISTINCT u.maintainer, s.source
+          FROM src_uploaders u
+          JOIN source s ON s.id = u.source
+          JOIN latest l ON l.source = s.source
+         WHERE s.dm_upload_allowed IS TRUE
+           AND l.dm_upload_allowed IS TRUE
+           AND u.maintainer = ANY(%s)
+        """, (list(by_mid.keys()),))
+        for mid, source in cur:
+            for rec in by_mid[mid]:
+                rec["sources"].add(source)
+
     def is_dmua(self, source):
         cur = self.conn.cursor()
         cur.execute("""
@@ -6,6 +6,7 @@ Replace this with more appropriate tests for your application.
 """
 
 from django.test import TestCase
+from . import models as pmodels
 
 
 class SimpleTest(TestCase):
@@ -14,3 +15,35 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class DakNamesTest(TestCase):
+    def test_last_row_wins(self):
+        names = pmodels.DakNames([
+            (1, "Foo Bar <foo@example.org>"),
+            (2, "Foo Bar <bar@example.org>"),
+            (3, "Baz Qux <foo@example.org>"),
+        ])
+        # Duplicate names and emails resolve to the last row
+        self.assertEquals(names.match("Foo Bar", None), (2, "Foo Bar", "bar@example.org"))
+        self.assertEquals(names.match(None, "foo@example.org"), (3, "Baz Qux", "foo@example.org"))
+        self.assertEquals(names.match(None, "bar@example.org"), (2, "Foo Bar", "bar@example.org"))
+
+    def test_name_or_email(self):
+        names = pmodels.DakNames([
+            (1, "Foo Bar <foo@example.org>"),
+            (2, "Baz Qux <baz@example.org>"),
+        ])
+        # If name and email match different rows, the later row wins,
+        # whichever of the two matched it
+        self.assertEquals(names.match("Foo Bar", "baz@example.org"), (2, "Baz Qux", "baz@example.org"))
+        self.assertEquals(names.match("Baz Qux", "foo@example.org"), (2, "Baz Qux", "baz@example.org"))
+        # Either one is enough
+        self.assertEquals(names.match("Foo Bar", "other@example.org"), (1, "Foo Bar", "foo@example.org"))
+        self.assertEquals(names.match("Someone Else", "foo@example.org"), (1, "Foo Bar", "foo@example.org"))
+        self.assertIsNone(names.match("Someone Else", "other@example.org"))
+
+    def test_unparsable(self):
+        # Rows that fix_maintainer cannot parse are skipped
+        names = pmodels.DakNames([(1, "Foo Bar")])
+        self.assertIsNone(names.match("Foo Bar", None))
@@ -5,8 +5,7 @@ import re
 
 register = template.Library()
 
-@register.filter(name='mc_format_entry')
-def mc_format_entry(value, keywords, autoescape=None):
+def _format_entry(value, keywords, ignore_case, autoescape):
     if autoescape:
         esc = conditional_escape
     else:
@@ -18,12 +17,18 @@ def mc_format_entry(value, keywords, autoescape=None):
     tokenizer = [re.escape(k) for k in keywords]
     tokenizer.append(r"#\d+")
     tokenizer = "(%s)" % "|".join(tokenizer)
-    tokenizer = re.compile(tokenizer)
+    if ignore_case:
+        tokenizer = re.compile(tokenizer, re.IGNORECASE | re.UNICODE)
+        keywords = frozenset(k.lower() for k in keywords)
+        normalise = lambda x: x.lower()
+    else:
+        tokenizer = re.compile(tokenizer)
+        keywords = frozenset(keywords)
+        normalise = lambda x: x
 
-    keywords = frozenset(keywords)
     tokenized = tokenizer.split(value)
     for i in xrange(len(tokenized)):
-        if tokenized[i] in keywords:
+        if normalise(tokenized[i]) in keywords:
             # highlight keywords
             tokenized[i] = "<b>%s</b>" % esc(tokenized[i])
         elif tokenized[i].startswith("#"):
@@ -37,4 +42,16 @@ def mc_format_entry(value, keywords, autoescape=None):
             tokenized[i] = esc(tokenized[i])
 
     return mark_safe("".join(tokenized))
+
+@register.filter(name='mc_format_entry')
+def mc_format_entry(value, keywords, autoescape=None):
+    return _format_entry(value, keywords, False, autoescape)
 mc_format_entry.needs_autoescape=True
+
+@register.filter(name='mc_format_entry_nocase')
+def mc_format_entry_nocase(value, keywords, autoescape=None):
+    """
+    Like mc_format_entry, but highlight keywords regardless of case
+    """
+    return _format_entry(value, keywords, True, autoescape)
+mc_format_entry_nocase.needs_autoescape=True
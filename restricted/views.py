@@ -24,6 +24,7 @@ from django.core.exceptions import PermissionDenied
 import backend.models as bmodels
 import minechangelogs.models as mmodels
 from backend import const
+from backend import utils
 import backend.auth
 import backend.email
 import json
@@ -301,7 +302,7 @@ class MinechangelogsForm(forms.Form):
     query = forms.CharField(
         required=True,
         label=_("Query"),
-        help_text=_("Enter one keyword per line. Changelog entries to be shown must match at least one keyword. You often need to tweak the keywords to improve the quality of results. Note that keyword matching is case-sensitive."),
+        help_text=_("Enter one keyword per line. Changelog entries to be shown must match at least one keyword. You often need to tweak the keywords to improve the quality of results. Note that keyword matching is case-sensitive, unless \"Ignore case\" is selected."),
         widget=forms.Textarea(attrs=dict(rows=5, cols=40))
     )
     download = forms.BooleanField(
@@ -309,6 +310,31 @@ class MinechangelogsForm(forms.Form):
         label=_("Download"),
         help_text=_("Activate this field to download the changelog instead of displaying it"),
     )
+    compression = forms.ChoiceField(
+        required=False,
+        label=_("Download compression"),
+        choices=[("", _("None"))] + [(x, x) for x in utils.COMPRESSIONS],
+        initial="",
+    )
+    ignore_case = forms.BooleanField(
+        required=False,
+        label=_("Ignore case"),
+        help_text=_("Match keywords regardless of upper or lower case"),
+    )
+    order = forms.ChoiceField(
+        required=False,
+        label=_("Order"),
+        choices=(("date", _("Newest first")), ("relevance", _("Most relevant first"))),
+        initial="date",
+    )
+    # Set by the pagination buttons
+    page = forms.IntegerField(required=False, min_value=1, widget=forms.HiddenInput)
+
+# Content type and file extension of compressed minechangelogs downloads
+DOWNLOAD_COMPRESSIONS = {
+    "gzip": ("application/gzip", ".gz"),
+    "xz": ("application/x-xz", ".xz"),
+}
 
 def minechangelogs(request, key=None):
     entries = None
@@ -327,20 +353,34 @@ def minechangelogs(request, key=None):
         if form.is_valid():
             query = form.cleaned_data["query"]
             keywords = [x.strip() for x in query.split("\n")]
-            entries = mmodels.query(keywords)
+            order = form.cleaned_data["order"] or "date"
+            ignore_case = form.cleaned_data["ignore_case"]
             if form.cleaned_data["download"]:
+                entries = mmodels.query(keywords, order=order, ignore_case=ignore_case)
                 def send_entries():
                     for e in entries:
                         yield e
                         yield "\n\n"
-                res = http.HttpResponse(send_entries(), content_type="text/plain")
+                compression = form.cleaned_data["compression"]
+                if compression:
+                    # Compress while reading from the index, without
+                    # collecting the results in memory
+                    content = utils.compress_stream(send_entries(), compression)
+                    content_type, ext = DOWNLOAD_COMPRESSIONS[compression]
+                else:
+                    content = send_entries()
+                    content_type, ext = "text/plain", ""
+                res = http.HttpResponse(content, content_type=content_type)
                 if person:
-                    res["Content-Disposition"] = 'attachment; filename=changelogs-%s.txt' % person.lookup_key
+                    res["Content-Disposition"] = 'attachment; filename=changelogs-%s.txt%s' % (person.lookup_key, ext)
                 else:
-                    res["Content-Disposition"] = 'attachment; filename=changelogs.txt'
+                    res["Content-Disposition"] = 'attachment; filename=changelogs.txt%s' % ext
                 return res
             else:
-                entries = list(entries)
+                page = form.cleaned_data["page"] or 1
+                entries = mmodels.search(keywords,
+                                         offset=(page - 1) * mmodels.MINECHANGELOGS_PAGE_SIZE,
+                                         order=order, ignore_case=ignore_case)
     else:
         if person:
             query = [
@@ -349,9 +389,11 @@ def minechangelogs(request, key=None):
             ]
             if person.uid:
                 query.append(person.uid)
-            form = MinechangelogsForm(initial=dict(query="\n".join(query)))
+            # Ignoring case is only possible once the index has been
+            # rebuilt with the case-folded terms
+            form = MinechangelogsForm(initial=dict(query="\n".join(query), ignore_case=info["current_terms"]))
         else:
-            form = MinechangelogsForm()
+            form = MinechangelogsForm(initial=dict(ignore_case=info["current_terms"]))
 
     return render_to_response("restricted/minechangelogs.html",
                               dict(
@@ -195,6 +195,12 @@ KEYRINGS = os.path.join(DATA_DIR, "keyrings")
 # Location of temporary keyrings used by keycheck
 KEYRINGS_TMPDIR = os.path.join(DATA_DIR, "tmp_keyrings")
 
+# Cache of the parsed keyring changelog
+KEYRINGS_CHANGELOG_CACHE = os.path.join(DATA_DIR, "keyring-changelog.cache")
+
+# Cache of DM information from projectb
+PROJECTB_DM_CACHE = os.path.join(DATA_DIR, "make-dm-list.cache")
+
 # Work paths used by minechangelogs (indexing cache and the index itself)
 MINECHANGELOGS_CACHEDIR = os.path.join(DATA_DIR, "mc_cache")
 MINECHANGELOGS_INDEXDIR = os.path.join(DATA_DIR, "mc_index")